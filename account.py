@@ -1,40 +1,155 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import pytz
 import json
-import bitstamp as trading
+import lots
+import money
+import export
+import valuation
+from api import get_api, DEFAULT
+from array import array
 from datetime import datetime
+from functools import lru_cache
 
 DECIMALS = 7
 
+VERSION = 3 # 1: float balances and amounts, 2: integer units (see money.py), 3: lots and realized P&L (see lots.py)
+
+PERSISTENT = ('user', 'currency', 'balance', 'initial_balance', 'api', 'historic', 'positions', 'method', 'realized', 'ledgers')
+
+TRANSIENT = ('_version', '_values', '_equity', '_valued', '_exposure') # valuation cache and exposure index, never persisted
+
+@lru_cache(maxsize=4096)
+def symbol_of(pair, currency):
+    """ Interned SYMBOL of a pair (or symbol) in the account currency, e.g. ethusd -> ETH """
+    return sys.intern(pair.upper().replace(currency, '', 1))
+
 class Position:
 
+    __slots__ = ('symbol', 'amount')
+
     def __init__(self, symbol, amount):
         self.symbol = symbol
-        self.amount = amount
+        self.amount = amount # units of symbol
 
     def __repr__(self):
-        return f"{self.symbol}: {round(self.amount, DECIMALS)}"
+        return f"{self.symbol}: {money.fmt(self.amount, self.symbol, DECIMALS)}"
+
+class Positions:
+    """ SYMBOL to amount in units, as a list of interned symbols and an array of 64-bit amounts """
+
+    __slots__ = ('symbols', 'amounts')
+
+    def __init__(self, amounts=()):
+        """ amounts: iterable of (SYMBOL, amount) """
+        self.symbols = list()
+        self.amounts = array('q')
+        for symbol, amount in amounts:
+            self[symbol] = amount
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self.symbols
+
+    def __getitem__(self, symbol):
+        return self.amounts[self.symbols.index(symbol)]
+
+    def get(self, symbol, default=0):
+        return self.amounts[self.symbols.index(symbol)] if symbol in self.symbols else default
+
+    def __setitem__(self, symbol, amount):
+        """ Set the amount of a position, removing it if the amount is 0 """
+        if symbol in self.symbols:
+            i = self.symbols.index(symbol)
+            if amount == 0:
+                del self.symbols[i], self.amounts[i]
+            else:
+                self.__store(i, amount)
+        elif amount != 0:
+            self.symbols.append(sys.intern(symbol))
+            self.__store(None, amount)
+
+    def __store(self, i, amount):
+        try:
+            if i is None:
+                self.amounts.append(amount)
+            else:
+                self.amounts[i] = amount
+        except OverflowError: # more than 2^63 units, fall back to Python ints
+            self.amounts = list(self.amounts)
+            self.__store(i, amount)
+
+    def pop(self, symbol):
+        i = self.symbols.index(symbol)
+        amount = self.amounts[i]
+        del self.symbols[i], self.amounts[i]
+        return amount
+
+    def items(self):
+        return zip(self.symbols, self.amounts)
+
+    def values(self):
+        """ Position views, for display """
+        return [Position(symbol, amount) for symbol, amount in self.items()]
 
 class Account:
 
-    def __init__(self, user, balance, currency, min_trade):
+    __slots__ = PERSISTENT + TRANSIENT + ('__weakref__',)
+
+    def __init__(self, user, balance, currency, api=DEFAULT):
+        """ balance: initial balance in currency (not in units) """
         self.user = user
-        self.balance = balance
-        self.currency = currency.upper()
-        self.initial_balance = balance
-        # TODO: min_trade is API dependent, change min_trade to api parameter
-        self.min_trade = max(0, min_trade)
-        self.historic = list()
-        self.positions = dict() # SYMBOL to Position
+        self.currency = sys.intern(currency.upper())
+        self.balance = money.units(balance, self.currency)
+        self.initial_balance = self.balance
+        self.api = api
+        self.historic = list() # UTF-8 encoded trade records, 4x smaller than str with emojis
+        self.positions = Positions()
+        self.method = lots.FIFO # cost method of the ledgers
+        self.realized = 0 # realized P&L in units of currency
+        self.ledgers = dict() # SYMBOL to lots.Ledger, for the positions with a known cost basis
+        self.__reset()
+
+    def __reset(self):
+        self._version = 0 # incremented on every trade
+        self._values = None # SYMBOL to (conversion route, market value) once valued, see valuation.py
+        self._equity = None
+        self._valued = None # (version, exchange) of the cached valuation
+        self._exposure = None # exposure.Index of the accounts holding this account, see trading.Accounts
+
+    def __getstate__(self):
+        return { k: getattr(self, k) for k in PERSISTENT }
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.__reset()
 
     def __str__(self):
-        positions = '\nPositions:\n' + '\n'.join(map(lambda p: '\t- ' + str(p), self.positions.values())) if len(self.positions) > 0 else ''
-        equity = self.equity()
+        equity = self.equity() # values every position from one price snapshot
+        positions = '\nPositions:\n' + '\n'.join(map(self.__position, self.positions.items())) if len(self.positions) > 0 else ''
         ret = Account.percent(equity / self.initial_balance)
-        return f"User: {self.user}\nBalance: {self.__price(self.balance)}\nEquity: {self.__price(equity)}\nReturn: {round(ret, 3)}%{positions}"
+        pnl = f"\nRealized P&L: {self.__pnl(self.realized)} ({self.method})"
+        return f"User: {self.user}\nExchange: {self.exchange()}\nBalance: {self.__price(self.balance)}\nEquity: {self.__price(equity)}\nReturn: {round(ret, 3)}%{pnl}{positions}"
+
+    def __position(self, position):
+        """ Position with its value and unrealized P&L from the last valuation """
+        symbol, amount = position
+        text = f"\t- {symbol}: {money.fmt(amount, symbol, DECIMALS)}"
+        if self._values and symbol in self._values:
+            value = self._values[symbol][1]
+            text += f", value {self.__price(value)}"
+            ledger = self.ledgers.get(symbol)
+            if ledger and ledger.cost:
+                text += f", P&L {self.__pnl(value - ledger.cost)} ({Account.percent(value / ledger.cost):+.2f}%)"
+        return text
 
-    # TODO: add api parameter, instantiate Decoder with api argument
     def load(file):
         with open(file, 'r') as account_file:
             return json.load(account_file, cls=Decoder)
@@ -43,15 +158,34 @@ class Account:
         with open(file, 'w') as account_file:
             json.dump(self, account_file, default=dumper)
 
+    def toJSON(self):
+        d = self.__getstate__()
+        d['historic'] = [record.decode('utf-8') for record in self.historic]
+        d['positions'] = { symbol: { 'symbol': symbol, 'amount': amount } for symbol, amount in self.positions.items() }
+        for symbol, ledger in d.pop('ledgers').items():
+            d['positions'][symbol]['lots'] = ledger.toJSON()
+        d['version'] = VERSION
+        return d
+
+    def exchange(self):
+        return get_api(self.api) or get_api(DEFAULT)
+
     def percent(d):
         return (d - 1) * 100
 
     def __symbol(self, symbol):
-        return symbol.upper().replace(self.currency, '', 1)
+        return symbol_of(symbol, self.currency)
+
+    def use_method(self, method):
+        """ Close lots by method (one of lots.METHODS) from now on """
+        self.method = method
+        if method == lots.AVERAGE:
+            for ledger in self.ledgers.values():
+                ledger.average()
 
     def get(self, symbol):
-        symbol = self.__symbol(symbol)
-        return self.positions[symbol].amount if symbol in self.positions else 0.0
+        """ Amount of symbol in units """
+        return self.positions.get(self.__symbol(symbol))
 
     def history(self, last=None):
         trades = len(self.historic)
@@ -60,76 +194,174 @@ class Account:
         historic = f"Total trades: {trades}\n\n"
         if last and trades > last:
             historic += f"Last {last} trades:\n\n"
-        historic += '\n\n'.join(self.historic[-last:] if last else self.historic)
+        historic += '\n\n'.join(record.decode('utf-8') for record in (self.historic[-last:] if last else self.historic))
         return historic
 
     def now():
         return datetime.now(pytz.UTC).strftime("%d-%m-%Y %H:%M:%S %Z")
 
     def __price(self, p, precision=2):
-        return f"{round(p, precision)} {self.currency}"
+        """ p: amount in units of the account currency """
+        return f"{money.fmt(p, self.currency, precision)} {self.currency}"
 
-    def __record(self, action, symbol, amount, price, cost, fee, comment):
-        record = Account.now()
+    def __quote(self, current):
+        """ current: price in price units """
+        return f"{money.fmt(current, self.currency, DECIMALS, money.PRICE_SCALE)} {self.currency}"
+
+    def __amount(self, amount, symbol):
+        return f"{money.fmt(amount, symbol, DECIMALS)} {symbol}"
+
+    def __pnl(self, p):
+        return f"{'+' if p >= 0 else ''}{self.__price(p)}"
+
+    def __fill(self, action, symbol, amount, price, cost, fee, detail='', realized=None):
         icon = '📈' if action == 'BUY' else '📉'
-        record += f"\n{icon} {action} {round(amount, DECIMALS)} {symbol} at {self.__price(price, DECIMALS)} for {self.__price(cost)} with {self.__price(fee)} fees."
-        record += f"\nEquity: {self.__price(self.equity())}"
+        fill = f"{icon} {action} {self.__amount(amount, symbol)} at {self.__quote(price)} for {self.__price(cost)} with {self.__price(fee)} fees."
+        fill += f"\n{detail}" if detail else ''
+        fill += f"\nRealized P&L: {self.__pnl(realized)}" if realized is not None else ''
+        return fill
+
+    def __record(self, fills, comment):
+        record = Account.now()
+        record += '\n' + '\n'.join(fills)
+        try:
+            equity = self.__price(self.equity())
+        except ValueError: # another position has no price, the trade is already applied
+            equity = 'unavailable'
+        record += f"\nEquity: {equity}"
         record += f"\nComment: {comment}" if comment else ''
-        self.historic.append(record)
+        self.historic.append(record.encode('utf-8'))
         record += f"\n\nPerform /account {self.user} for more information."
         return record
 
     def equity(self):
-        return self.balance + sum(list(map(lambda p: p.amount * trading.get_price(p.symbol + self.currency), self.positions.values())))
+        """ Balance plus the value of every position, in units of the account currency """
+        return valuation.equity(self)
 
-    def buy(self, symbol, current, amount, fee, comment='', base=0):
-        if self.balance <= 0:
-            return f"Insufficient balance: {self.__price(self.balance)}."
+    def buy(self, symbol, current, amount, fee, comment='', detail=''):
+        """ Buy an amount of symbol at the current price with a fee rate (e.g. 0.005), detail describes the fill """
         symbol = self.__symbol(symbol)
-        open = amount * current
-        # TODO: Use self.api.min_trade instead
-        if open < self.min_trade:
-            return f"Trade price must be greater than {self.__price(self.min_trade)}. Current is {self.__price(open)} ({round(amount, DECIMALS)} {symbol} at price {self.__price(current, DECIMALS)})."
-        open_fee = fee * (base or open)
+        return self.__buy(symbol, money.price(current), money.units(amount, symbol), money.rate(fee), comment, detail=detail)
+
+    def __buy(self, symbol, current, amount, fee, comment='', base=0, detail=''):
+        error, open, open_fee, _ = self.__open(symbol, current, amount, fee, comment, base)
+        if error:
+            return error
+        return self.__record([self.__fill('BUY', symbol, amount, current, open, open_fee, detail)], comment)
+
+    def __open(self, symbol, current, amount, fee, comment='', base=0):
+        """ Apply a BUY, returns (error message or None, cost, fee, None) """
+        if self.balance <= 0:
+            return f"Insufficient balance: {self.__price(self.balance)}.", 0, 0, None
+        open = money.cost(amount, symbol, current, self.currency, up=True)
+        min_trade = money.units(self.exchange().min_trade, self.currency)
+        if open < min_trade:
+            return f"Trade price must be greater than {self.__price(min_trade)}. Current is {self.__price(open)} ({self.__amount(amount, symbol)} at price {self.__quote(current)}).", 0, 0, None
+        open_fee = money.fee(base or open, fee)
         open_with_fees = open + open_fee
         if self.balance < open_with_fees:
-            max_fees = fee * self.balance
-            max_amount_with_fees = (self.balance - max_fees) / current
-            return f"Insufficient balance: {self.__price(self.balance)}. Maximum: {round(max_amount_with_fees, DECIMALS)} {symbol} at price {self.__price(current, DECIMALS)} with {self.__price(max_fees)} fees ({fee * 100}%).\n\nUse /tradeAll BUY {symbol} {comment}"
+            max_fees = money.fee(self.balance, fee)
+            max_amount_with_fees = money.affordable(self.balance - max_fees, self.currency, current, symbol)
+            return f"Insufficient balance: {self.__price(self.balance)}. Maximum: {self.__amount(max_amount_with_fees, symbol)} at price {self.__quote(current)} with {self.__price(max_fees)} fees ({fee * 100 / money.RATE_SCALE}%).\n\nUse /tradeAll BUY {symbol} {comment}", 0, 0, None
         self.balance -= open_with_fees
-        position = Position(symbol, amount)
-        self.positions[symbol] = position
-        return self.__record('BUY', symbol, amount, current, open, open_fee, comment)
+        self._version += 1
+        previous = self.positions.get(symbol)
+        if self._exposure is not None:
+            self._exposure.change(symbol, previous, previous + amount)
+        self.positions[symbol] = previous + amount
+        if previous == 0 or symbol in self.ledgers: # positions opened before ledgers keep an unknown cost basis
+            self.ledgers.setdefault(symbol, lots.Ledger()).open(amount, open_with_fees, self.method)
+        return None, open, open_fee, None
+
+    def __max_buy(self, symbol, current, fee):
+        fees = money.fee(self.balance, fee)
+        return money.affordable(self.balance - fees, self.currency, current, symbol)
 
-    def buy_all(self, symbol, current, fee, comment=''):
-        fees = fee * self.balance
-        max_amount_with_fees = (self.balance - fees) / current
-        return self.buy(symbol, current, max_amount_with_fees, fee, comment, base=self.balance)
+    def buy_all(self, symbol, current, fee, comment='', detail=''):
+        symbol = self.__symbol(symbol)
+        current, fee = money.price(current), money.rate(fee)
+        return self.__buy(symbol, current, self.__max_buy(symbol, current, fee), fee, comment, base=self.balance, detail=detail)
 
-    def sell(self, symbol, current, amount, fee, comment=''):
+    def sell(self, symbol, current, amount, fee, comment='', detail=''):
+        """ Sell an amount of symbol at the current price with a fee rate (e.g. 0.005), detail describes the fill """
         symbol = self.__symbol(symbol)
-        close = amount * current
-        # TODO: Use self.api.min_trade instead
-        if close < self.min_trade:
-            return f"Trade price must be greater than {self.__price(self.min_trade)}. Current is {self.__price(close)} ({round(amount, DECIMALS)} {symbol} at price {self.__price(current)})."
+        return self.__sell(symbol, money.price(current), money.units(amount, symbol), money.rate(fee), comment, detail)
+
+    def __sell(self, symbol, current, amount, fee, comment='', detail=''):
+        error, close, close_fee, realized = self.__close(symbol, current, amount, fee, comment)
+        if error:
+            return error
+        return self.__record([self.__fill('SELL', symbol, amount, current, close, close_fee, detail, realized)], comment)
+
+    def __close(self, symbol, current, amount, fee, comment=''):
+        """ Apply a SELL, returns (error message or None, proceeds, fee, realized P&L or None if the cost basis is unknown) """
+        close = money.cost(amount, symbol, current, self.currency)
+        min_trade = money.units(self.exchange().min_trade, self.currency)
+        if close < min_trade:
+            return f"Trade price must be greater than {self.__price(min_trade)}. Current is {self.__price(close)} ({self.__amount(amount, symbol)} at price {self.__quote(current)}).", 0, 0, None
         total_amount = self.get(symbol)
         if amount > total_amount:
-            return f"Invalid amount: {round(amount, DECIMALS)} {symbol}. Available: {round(total_amount, DECIMALS)} {symbol}.\n\nUse /tradeAll SELL {symbol} {comment}"
-        elif amount < total_amount:
-            position = self.positions[symbol]
-            position.amount = position.amount - amount
-        else:
-            self.positions.pop(symbol)
-        close_fee = fee * close
+            return f"Invalid amount: {self.__amount(amount, symbol)}. Available: {self.__amount(total_amount, symbol)}.\n\nUse /tradeAll SELL {symbol} {comment}", 0, 0, None
+        if self._exposure is not None:
+            self._exposure.change(symbol, total_amount, total_amount - amount)
+        self.positions[symbol] = total_amount - amount
+        close_fee = money.fee(close, fee)
         close_with_fees = close - close_fee
         self.balance += close_with_fees
-        return self.__record('SELL', symbol, amount, current, close, close_fee, comment)
+        self._version += 1
+        ledger = self.ledgers.get(symbol)
+        if ledger is None:
+            return None, close, close_fee, None
+        realized = close_with_fees - ledger.close(amount, self.method)
+        self.realized += realized
+        if ledger.amount == 0:
+            del self.ledgers[symbol]
+        return None, close, close_fee, realized
 
-    def sell_all(self, symbol, current, fee, comment=''):
+    def sell_all(self, symbol, current, fee, comment='', detail=''):
+        symbol = self.__symbol(symbol)
         amount = self.get(symbol)
         if amount == 0:
-            return f"There is no position open for {self.__symbol(symbol)}."
-        return self.sell(symbol, current, amount, fee, comment)
+            return f"There is no position open for {symbol}."
+        return self.__sell(symbol, money.price(current), amount, money.rate(fee), comment, detail)
+
+    def batch(self, orders, prices, fee, comment=''):
+        """
+        Execute many orders atomically: all of them or none, recorded as a single trade
+
+        orders: list of (action, pair symbol, amount), amount None for the maximum available
+        prices: pair symbol to current price
+        fee: fee rate (e.g. 0.005)
+        """
+        balance, amounts, realized = self.balance, list(self.positions.items()), self.realized
+        touched = set(self.__symbol(pair) for _, pair, _ in orders)
+        ledgers = { symbol: self.ledgers[symbol].copy() for symbol in touched if symbol in self.ledgers }
+        fee = money.rate(fee)
+        fills = []
+        for action, pair, amount in orders:
+            symbol = self.__symbol(pair)
+            current = money.price(prices[pair])
+            if action == 'BUY':
+                base = self.balance if amount is None else 0
+                amount = self.__max_buy(symbol, current, fee) if amount is None else money.units(amount, symbol)
+                error, total, total_fee, pnl = self.__open(symbol, current, amount, fee, comment, base)
+            else:
+                amount = self.get(symbol) if amount is None else money.units(amount, symbol)
+                error, total, total_fee, pnl = self.__close(symbol, current, amount, fee, comment) if amount else (f"There is no position open for {symbol}.", 0, 0, None)
+            if error:
+                self.balance, self.realized = balance, realized
+                if self._exposure is not None:
+                    self._exposure.remove(self)
+                self.positions = Positions(amounts)
+                if self._exposure is not None:
+                    self._exposure.add(self)
+                for held in touched:
+                    self.ledgers.pop(held, None)
+                self.ledgers.update(ledgers)
+                self._version += 1
+                return f"Batch rejected, no order was executed.\n\n{action} {symbol}: {error}"
+            fills.append(self.__fill(action, symbol, amount, current, total, total_fee, realized=pnl))
+        return self.__record([f"📦 BATCH {len(fills)} orders"] + fills, comment)
 
 def dumper(obj):
     try:
@@ -140,12 +372,38 @@ def dumper(obj):
 class Decoder(json.JSONDecoder):
     def decode(self, s):
         d = super(Decoder, self).decode(s)
-        # TODO: Pass api argument instead min_trade
-        account = Account(d['user'], d['balance'], d['currency'], d['min_trade'])
-        account.initial_balance = d['initial_balance']
-        account.historic = d['historic']
-        positions = dict()
-        for symbol, pos in d['positions'].items():
-            positions[symbol] = Position(symbol, pos['amount'])
-        account.positions = positions
-        return account
\ No newline at end of file
+        account = Account(d['user'], 0, d['currency'], d.get('api', DEFAULT))
+        if d.get('version', 1) < 2:
+            # float balances and amounts are converted to the nearest unit
+            units = lambda value, currency: money.units(value, currency)
+        else:
+            units = lambda value, currency: value
+        account.balance = units(d['balance'], account.currency)
+        account.initial_balance = units(d['initial_balance'], account.currency)
+        account.historic = [record.encode('utf-8') for record in d['historic']]
+        account.positions = Positions((symbol, units(pos['amount'], symbol)) for symbol, pos in d['positions'].items())
+        if d.get('version', 1) < 3:
+            account.ledgers = recover(account.historic, account.positions, account.currency)
+        else:
+            account.method, account.realized = d['method'], d['realized']
+            account.ledgers = { sys.intern(symbol): lots.Ledger(pos['lots']) for symbol, pos in d['positions'].items() if 'lots' in pos }
+        return account
+
+def recover(historic, positions, currency):
+    """
+    Ledgers of the positions of an account saved before lots, from its trade records. A BUY used to replace the
+    position, so a position is what is left of its last BUY: one lot at the cost of that BUY, prorated.
+    """
+    last = dict()
+    for row in export.trades(None, historic):
+        trade = dict(zip(export.COLUMNS, row))
+        if trade['action'] == 'BUY':
+            last[trade['symbol']] = trade
+    ledgers = dict()
+    for symbol, amount in positions.items():
+        trade = last.get(symbol)
+        bought = money.units(trade['amount'], symbol) if trade else 0
+        if bought and 0 < amount <= bought + 10 ** max(money.scale(symbol) - DECIMALS, 0): # records truncate amounts to DECIMALS
+            cost = money.units(trade['cost'], currency) + money.units(trade['fee'], currency)
+            ledgers[symbol] = lots.Ledger([(amount, cost * min(amount, bought) // bought)])
+    return ledgers
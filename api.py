@@ -1,31 +1,87 @@
 import re
+import time
+import money
+import config
+import metrics
+import threading
 
-from requests import get
+from requests import Session, RequestException, Timeout
+from requests.adapters import HTTPAdapter
+from circuit import CircuitBreaker
 from json import loads as json
+from typing import Callable
+from collections import namedtuple
 
-from abc import ABC, abstractmethod 
+from abc import ABC, abstractmethod
 
 NON_ALPHA = r'[^a-zA-Z]'
 
+DEFAULT = 'Bitstamp'
+
+QUOTE_TTL_SECONDS = 5
+
+BOOK_TTL_SECONDS = 2 # order book snapshots are shared by the fills of this window
+
+BOOK_DEPTH = 100 # levels kept per side of an order book
+
+DEFAULT_TIMEOUT_SECONDS = 5 # per request, see API.TIMEOUTS
+
+STALE_SECONDS = config.get('stale_quote_seconds', 300) # max age of the last known price served while an exchange is unavailable
+
+TICK_LISTENERS = list() # f(api, symbol, price) called when a cached quote changes
+
+PAIRS_LISTENERS = list() # f(api) called when the symbol index is replaced
+
+APIS = dict() # lowercase name to API
+
+POOL_SIZE = 32 # kept-alive connections per exchange host
+
+SESSION = Session() # connection pools shared by every API and every bot of the process
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=POOL_SIZE))
+SESSION.mount('http://', HTTPAdapter(pool_maxsize=POOL_SIZE))
+
 def symbol_id(symbol: str) -> str:
   return re.sub(NON_ALPHA, '', symbol.lower())
 
 def is_authorized(bot_name, from_user, superuser, target):
     return target == from_user or (superuser and target == bot_name)
 
-def __float(s):
-  try:
-      return True, float(s)
-  except ValueError:
-      return False, 0
+def register(api):
+  """ Register an API instance so accounts can select it by name """
+  APIS[api.name.lower()] = api
+  return api
+
+def get_api(name: str):
+  """ Get a registered API by name (case insensitive) or None if it is not available """
+  return APIS.get(name.lower()) if name else None
+
+def names() -> list:
+  """ Names of the registered APIs """
+  return [api.name for api in APIS.values()]
+
+Book = namedtuple('Book', 'bids asks') # levels (price units, amount in units of money.PRICE_SCALE), best first
+
+def parse_levels(levels):
+  """ Book levels from [price, amount] pairs as formatted by an exchange """
+  return tuple((money.price(price), money.units(amount, '', money.PRICE_SCALE)) for price, amount, *_ in levels[:BOOK_DEPTH])
+
+class StalePrice(float):
+  """ Last known price served while the exchange circuit is open, age in seconds """
+
+  def __new__(cls, price: float, age: float):
+    stale = super().__new__(cls, price)
+    stale.age = age
+    return stale
 
 class API(ABC):
   """ Trading API """
 
+  TIMEOUTS = dict() # endpoint to request timeout in seconds, DEFAULT_TIMEOUT_SECONDS otherwise
+
   def __init__(self, name: str, base_url: str, min_trade: float, fee: float, requests_limit_per_minute: int):
     """
     Create an instance of this API.
-    
+
     name: API name
     base_url: API base url to make requests
     min_trade: minimum total trade (price * amount)
@@ -33,100 +89,226 @@ class API(ABC):
     requests_limit_per_minute: maximum amount of requests allowed per minute
     """
     self.name = name
-  
-  def __get(self, url, callback, filter_status=True):
-    response = get(self.base_url + url)
+    self.base_url = base_url
+    self.min_trade = max(0, min_trade)
+    self.fee = fee
+    self.requests_limit_per_minute = requests_limit_per_minute
+    self.pairs = None # symbol index: cached (base, quote) pairs, see refresh_pairs
+    self.symbols = set() # pair symbols of the symbol index
+    self.quotes = dict() # pair symbol to (price, monotonic time)
+    self.books = dict() # pair symbol to (Book, monotonic time)
+    self.book_locks = dict() # pair symbol to the lock held while its book is fetched
+    self.lock = threading.Lock()
+    self.circuit = CircuitBreaker(name)
+
+  def __str__(self):
+    return self.name
+
+  def _get(self, url, callback, filter_status=True, endpoint=None):
+    endpoint = endpoint or url.split('?', 1)[0]
+    if not self.circuit.allow():
+      metrics.inc('circuit_rejected_total', service=self.name, endpoint=endpoint)
+      return f"{self.name} API: unavailable"
+    try:
+      with metrics.outbound(self.name, endpoint):
+        response = SESSION.get(self.base_url + url, timeout=self.TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT_SECONDS))
+    except RequestException as e:
+      metrics.error(self.name, endpoint)
+      self.circuit.failure()
+      return f"{self.name} API: {'timed out' if isinstance(e, Timeout) else 'unreachable'}"
     code = response.status_code
     success = code >= 200 and code < 300
-    content = json(response.content) if success else None
+    if not success:
+      metrics.error(self.name, endpoint)
+    if code >= 500 or code == 429: # client errors such as an invalid symbol do not count as failures
+      self.circuit.failure()
+    else:
+      self.circuit.success()
+    try:
+      content = json(response.content) if success else None
+    except ValueError:
+      self.circuit.failure()
+      return f"{self.name} API: invalid response"
     if not filter_status:
       return callback(content, code)
-    if code >= 200 and code < 300:
+    if success:
       return callback(content)
     return f"{self.name} API: {code}"
 
+  def symbol(self, symbol: str) -> str:
+    """ Pair symbol as expected by this API """
+    return symbol_id(symbol)
+
   @abstractmethod
   def ping(self) -> str:
     """ Test if API is reachable """
     pass
 
   @abstractmethod
-  def list_symbols(self) -> str:
-    """ List available symbol pairs """
-    pass
-
-  @abstractmethod
-  def __price(symbol: str, callback: function):
+  def _pairs(self, callback: Callable):
     """
-    Get the current price of a symbol and call the callback with the result
-    symbol: pair symbol
-    callback: (str -> float or str)
+    Get the available pairs and call the callback with the result
+    callback: (list of (base, quote) -> str)
     returns: callback result
     """
     pass
 
-  def get_price(self, symbol: str) -> float:
-    """ Get the current price of a symbol """
-    return self.__price(symbol_id(symbol), lambda price: float(price))
-    
-  @abstractmethod
-  def price(self, user: str, symbol: str) -> str:
-    pass
+  def refresh_pairs(self):
+    """ Fetch the available pairs into the symbol index, returns the pairs or an error message """
+    pairs = self._pairs(lambda pairs: pairs)
+    if isinstance(pairs, list):
+      self.set_pairs(pairs)
+    return pairs
 
-  @abstractmethod
-  def exists(self, symbol: str) -> bool:
-    """ Test if symbol is available in this API """
-    pass
+  def set_pairs(self, pairs):
+    """ Replace the symbol index """
+    self.symbols = set(map(lambda pair: self.symbol(''.join(pair)), pairs))
+    self.pairs = pairs
+    for listener in PAIRS_LISTENERS:
+      listener(self)
 
-  @abstractmethod
-  def account(bot_name: str, user: str, superuser: bool, other: str) -> str:
-    pass
+  def listed(self, symbol: str) -> bool:
+    """ Test if symbol is in the symbol index, without requests once the index is loaded """
+    if self.pairs is None and not isinstance(self.refresh_pairs(), list):
+      return self.exists(symbol) is True
+    return self.symbol(symbol) in self.symbols
 
-  @abstractmethod
-  def history(bot_name: str, user: str, superuser: bool, other: str) -> str:
-    pass
+  def list_symbols(self, currency: str = None) -> str:
+    """ List available symbol pairs, pairs in the provided currency first """
+    def list_pairs(pairs):
+      return '\n'.join(map(lambda pair: ''.join(pair), pairs))
+    def pairs_info(pairs):
+      if currency:
+        my_pairs = list(filter(lambda pair: currency in pair, pairs))
+        others = filter(lambda pair: currency not in pair, pairs)
+        list_pairs_info = f"Available symbols for your account (Currency {currency}):\n\n"
+        list_pairs_info += list_pairs(my_pairs)
+        list_pairs_info += "\n\nAvailable symbols in other currencies:\n\n"
+        list_pairs_info += list_pairs(others)
+        return list_pairs_info.rstrip()
+      return list_pairs(pairs)
+    pairs = self.pairs or self.refresh_pairs()
+    return pairs_info(pairs) if isinstance(pairs, list) else pairs
 
   @abstractmethod
-  def existsAccount(self, user: str) -> bool:
-    """ Check if a user has an account for this API """
+  def _price(self, symbol: str, callback: Callable):
+    """
+    Get the current price of a symbol and call the callback with the result
+    symbol: pair symbol, as returned by self.symbol
+    callback: (str -> float or str)
+    returns: callback result
+    """
     pass
 
-  def newAccount(self, user: str, args='') -> str:
+  def get_price(self, symbol: str, max_age: float = QUOTE_TTL_SECONDS) -> float:
+    """
+    Get the current price of a symbol, from the quote cache if it is younger than max_age seconds.
+    While the circuit is open, the last known price is returned as a StalePrice if it is younger than STALE_SECONDS.
     """
-    Create a user account
+    symbol = self.symbol(symbol)
+    cached = self.quotes.get(symbol)
+    if cached and time.monotonic() - cached[1] < max_age:
+      metrics.hit('quotes')
+      return cached[0]
+    metrics.miss('quotes')
+    price = self._price(symbol, lambda price: float(price))
+    if isinstance(price, float):
+      self.tick(symbol, price)
+      return price
+    return self._stale(symbol) or price
 
-    args: [balance] [currency]
+  def _stale(self, symbol: str):
+    """ Last known price of a pair symbol as a StalePrice, or None if the circuit is closed or it is too old """
+    cached = self.quotes.get(symbol)
+    if cached and self.circuit.is_open():
+      age = time.monotonic() - cached[1]
+      if age <= STALE_SECONDS:
+        metrics.inc('stale_quotes_total', service=self.name)
+        return StalePrice(cached[0], age)
+    return None
+
+  def _tickers(self, callback: Callable):
     """
-    args = args.split(' ', 1)
-    balance = args[0] if args[0] else '1000'
-    success, balance = __float(balance)
-    if not success:
-        return "Balance must be in decimal format. For example: 500.25 USD"
-    currency = 'USD' if len(args) < 2 else args[1]
-    return self.__newAccount(user, balance, currency)
+    Get the last price of every pair in a single request and call the callback with the result
+    callback: (dict of pair symbol to str -> dict or str)
+    returns: callback result, None if this API has no such endpoint
+    """
+    return None
 
-  @abstractmethod
-  def __newAccount(self, user: str, balance: float, currency: str) -> str:
-    pass
+  def get_prices(self, symbols) -> dict:
+    """ Prices of many symbols from one snapshot (a single request if the API supports it), returns pair symbol to price or an error message """
+    symbols = set(map(self.symbol, symbols))
+    tickers = self._tickers(lambda tickers: tickers)
+    if tickers is None:
+      prices = { symbol: self.get_price(symbol, max_age=0) for symbol in symbols }
+      errors = [price for price in prices.values() if not isinstance(price, float)]
+      return errors[0] if errors else prices
+    if not isinstance(tickers, dict):
+      return tickers
+    prices = dict()
+    for symbol, price in tickers.items():
+      symbol = self.symbol(symbol)
+      if price is not None:
+        self.tick(symbol, float(price))
+        if symbol in symbols:
+          prices[symbol] = float(price)
+    missing = symbols - prices.keys()
+    return f"Invalid symbol: {', '.join(sorted(missing)).upper()}. See /list" if missing else prices
 
-  @abstractmethod
-  def deleteAccount(self, user: str) -> str:
-    pass
+  def _order_book(self, symbol: str, callback: Callable):
+    """
+    Get the order book of a symbol and call the callback with the result
+    symbol: pair symbol, as returned by self.symbol
+    callback: (list of bids, list of asks -> Book or str), levels as [price, amount] strings, best first
+    returns: callback result, None if this API has no such endpoint
+    """
+    return None
 
-  @abstractmethod
-  def trade(self, user: str, order: str) -> str:
-    pass
+  def get_book(self, symbol: str, max_age: float = BOOK_TTL_SECONDS):
+    """
+    Order book snapshot of a symbol, from the book cache if it is younger than max_age seconds.
+    Concurrent callers of the same symbol wait for a single request and share its snapshot.
+    returns: Book, an error message or None if this API has no order book endpoint
+    """
+    symbol = self.symbol(symbol)
+    cached = self.books.get(symbol)
+    if cached and time.monotonic() - cached[1] < max_age:
+      metrics.hit('books')
+      return cached[0]
+    with self.lock:
+      lock = self.book_locks.setdefault(symbol, threading.Lock())
+    with lock:
+      cached = self.books.get(symbol)
+      if cached and time.monotonic() - cached[1] < max_age: # fetched while waiting
+        metrics.hit('books')
+        return cached[0]
+      metrics.miss('books')
+      book = self._order_book(symbol, lambda bids, asks: Book(parse_levels(bids), parse_levels(asks)))
+      if isinstance(book, Book):
+        self.books[symbol] = (book, time.monotonic())
+      return book
 
-  @abstractmethod
-  def tradeAll(self, user: str, order: str) -> str:
-    pass
+  def tick(self, symbol: str, price: float):
+    """ Store a new quote, listeners are notified only if the price changed """
+    previous = self.quotes.get(symbol)
+    self.quotes[symbol] = (price, time.monotonic())
+    if previous is None or previous[0] != price:
+      for listener in TICK_LISTENERS:
+        listener(self, symbol, price)
 
-  @abstractmethod
-  def load(self):
-    """ Load accounts and API resources """
-    pass
+  def price(self, symbol: str) -> str:
+    """ Get the current price of a symbol as a message """
+    pair = self.symbol(symbol)
+    current = self._price(pair, lambda current: (current,)) # as formatted by the API
+    if isinstance(current, tuple):
+      self.tick(pair, float(current[0]))
+      return f"{symbol.upper()}: {current[0]}"
+    stale = self._stale(pair)
+    if stale is not None:
+      return f"{symbol.upper()}: {stale} (stale, {round(stale.age)}s old, {self.name} is unavailable)"
+    return current
 
   @abstractmethod
-  def save(self):
-    """ Save accounts and API resources """
+  def exists(self, symbol: str) -> bool:
+    """ Test if symbol is available in this API """
     pass
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks for the trading hot paths.
+
+Exchanges are served by the mock exchange (mockexchange.py, at fixed prices) and alerts by a fake IMAP server,
+so no tokens or network access are needed. Results are printed (or saved) as JSON to compare runs:
+
+    python3 benchmark.py --latency 5 --output bench.json
+    python3 benchmark.py --baseline bench.json --threshold 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tempfile
+import argparse
+import itertools
+import threading
+import statistics
+
+from string import ascii_uppercase
+from decimal import Decimal, ROUND_CEILING
+from datetime import datetime, timedelta
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from http.server import ThreadingHTTPServer
+
+import api
+import money
+import gmail
+import render
+import trading
+from account import Account
+from mockexchange import Market, MockExchange
+
+CURRENCY = 'USD'
+
+# STUBS
+
+def symbols(n):
+    """ n alphabetic coin symbols that do not contain the account currency """
+    coins = ['BTC', 'ETH', 'XRP', 'LTC']
+    for letters in itertools.product(ascii_uppercase, repeat=4):
+        if len(coins) >= n:
+            break
+        coin = ''.join(letters)
+        if CURRENCY not in coin:
+            coins.append(coin)
+    return coins[:n]
+
+class ImapStub(StreamRequestHandler):
+    """ Minimal IMAP4rev1 server answering the commands issued by gmail.update_alerts """
+
+    latency = 0
+    alerts = list() # (subject, date)
+    disable_nagle_algorithm = True
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.send('* OK IMAP4rev1 stub ready')
+        for line in self.rfile:
+            time.sleep(self.latency)
+            tag, command, *args = line.decode().rstrip('\r\n').split(' ', 2)
+            command = command.upper()
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1 AUTH=PLAIN AUTH=XOAUTH2')
+            elif command == 'AUTHENTICATE':
+                self.send('+ ')
+                self.rfile.readline() # base64 SASL response
+            elif command == 'SELECT':
+                self.send(f'* {len(self.alerts)} EXISTS')
+            elif command == 'SEARCH':
+                self.send('* SEARCH ' + ' '.join(str(i + 1) for i in range(len(self.alerts))))
+            elif command == 'UID':
+                uid = int(args[0].split(' ', 2)[1])
+                subject, date = self.alerts[uid - 1]
+                header = f"Subject: {gmail.PREFIX}{subject}\r\nDate: {date.strftime(gmail.DATE_TIME_FORMAT)}\r\n\r\n".encode()
+                self.wfile.write(f'* {uid} FETCH (UID {uid} BODY[HEADER.FIELDS (SUBJECT DATE)] {{{len(header)}}}\r\n'.encode() + header + b')\r\n')
+            elif command == 'LOGOUT':
+                self.send('* BYE')
+                self.send(f'{tag} OK LOGOUT completed')
+                return
+            self.send(f'{tag} OK {command} completed')
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_stubs(latency, pairs):
+    MockExchange.latency = latency
+    MockExchange.market = Market({ f"{coin}/{CURRENCY}": 100.0 + i for i, coin in enumerate(symbols(pairs)) }, volatility=0)
+    ImapStub.latency = latency
+    exchange = serve(ThreadingHTTPServer(('127.0.0.1', 0), MockExchange))
+    ThreadingTCPServer.allow_reuse_address = True
+    imap = serve(ThreadingTCPServer(('127.0.0.1', 0), ImapStub))
+    url = f"http://127.0.0.1:{exchange.server_address[1]}"
+    api.get_api('Bitstamp').base_url = url + '/api/v2'
+    api.get_api('Binance').base_url = url
+    MockExchange.url = url
+    gmail.ENABLED = True
+    gmail.GMAIL_MAIL = 'benchmark@localhost'
+    gmail.GMAIL_TOKEN = 'benchmark'
+    gmail.IMAP_SERVER, gmail.IMAP_PORT = imap.server_address
+    gmail.IMAP_SSL = False
+    return exchange, imap
+
+# MEASUREMENTS
+
+def measure(name, f, repeat, setup=None, **params):
+    """ Run f() repeat times (calling setup() before each run, untimed) and summarize the latencies in ms """
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        f()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    result = {
+        'name': name,
+        'params': params,
+        'runs': repeat,
+        'mean_ms': statistics.fmean(samples),
+        'p50_ms': samples[len(samples) // 2],
+        'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'min_ms': samples[0],
+        'max_ms': samples[-1]
+    }
+    print(f"{name} {params}: {result['mean_ms']:.3f} ms", file=sys.stderr)
+    return result
+
+def portfolio(user, positions, exchange='Bitstamp'):
+    account = Account(user, 1_000_000.0, CURRENCY, exchange)
+    for coin in symbols(positions):
+        account.positions[coin] = money.units(1, coin)
+    return account
+
+def bench_trade(repeat):
+    results = []
+    for exchange in api.names():
+        user = f'trade_{exchange}'
+        trading.ACCOUNTS[user] = Account(user, 1_000_000.0, CURRENCY, exchange)
+        orders = itertools.cycle(['BUY 1 BTC', 'SELL 1 BTC'])
+        results.append(measure('trade', lambda: trading.trade(user, next(orders)), repeat, exchange=exchange))
+        orders = itertools.cycle(['BUY BTC', 'SELL BTC'])
+        results.append(measure('tradeAll', lambda: trading.tradeAll(user, next(orders)), repeat, exchange=exchange))
+        coins = symbols(10)
+        orders = itertools.cycle(['\n'.join(f"BUY 1 {coin}" for coin in coins), '\n'.join(f"SELL ALL {coin}" for coin in coins)])
+        results.append(measure('batch', lambda: trading.batch(user, next(orders)), repeat, exchange=exchange, orders=len(coins)))
+        trading.ACCOUNTS.pop(user)
+    return results
+
+def bench_account(sizes, repeat):
+    results = []
+    for positions in sizes:
+        account = portfolio('equity', positions)
+        results.append(measure('Account.equity', account.equity, repeat, positions=positions))
+        results.append(measure('Account.__str__', account.__str__, repeat, positions=positions))
+    return results
+
+def bench_persistence(sizes, repeat):
+    results = []
+    for accounts in sizes:
+        trading.ACCOUNTS.clear()
+        for i in range(accounts):
+            account = portfolio(f'user{i}', 3)
+            trading.ACCOUNTS[account.user] = account
+        results.append(measure('trading.save', trading.save, repeat, accounts=accounts))
+        results.append(measure('trading.load', trading.load, repeat, setup=trading.ACCOUNTS.clear, accounts=accounts))
+        for user in os.listdir('accounts'):
+            os.remove(f'accounts/{user}')
+    trading.ACCOUNTS.clear()
+    return results
+
+def bench_list_symbols(pairs, repeat):
+    trading.ACCOUNTS['list'] = Account('list', 1000.0, CURRENCY)
+    results = [
+        measure('list_symbols', lambda: trading.list_symbols('list'), repeat, pairs=pairs),
+        measure('list_symbols.render', lambda: trading.list_symbols('list'), repeat, setup=render.invalidate, pairs=pairs)
+    ]
+    trading.ACCOUNTS.pop('list')
+    return results
+
+def bench_ledger(trades, repeat):
+    """ Fixed-point money against decimal.Decimal for the cost and fee computations of a trade """
+    amounts = [money.units(0.001 * (i + 1), 'BTC') for i in range(trades)]
+    current, fee = money.price(43210.12345678), money.rate(0.005)
+    def fixed():
+        balance = 0
+        for amount in amounts:
+            cost = money.cost(amount, 'BTC', current, CURRENCY, up=True)
+            balance += cost + money.fee(cost, fee)
+    decimal_amounts = [Decimal(amount) / 10 ** 8 for amount in amounts]
+    decimal_current, decimal_fee, cent = Decimal('43210.12345678'), Decimal('0.005'), Decimal('0.000001')
+    def decimal():
+        balance = Decimal(0)
+        for amount in decimal_amounts:
+            cost = (amount * decimal_current).quantize(cent, rounding=ROUND_CEILING)
+            balance += cost + (cost * decimal_fee).quantize(cent, rounding=ROUND_CEILING)
+    return [
+        measure('ledger.fixed', fixed, repeat, trades=trades),
+        measure('ledger.decimal', decimal, repeat, trades=trades)
+    ]
+
+def bench_alerts(sizes, repeat):
+    results = []
+    def reset():
+        if os.path.isfile('lastAlert'):
+            os.remove('lastAlert')
+    for alerts in sizes:
+        now = datetime.now(gmail.TIMEZONE)
+        ImapStub.alerts = [(f"buy BTC alert {i}", now - timedelta(seconds=alerts - i)) for i in range(alerts)]
+        results.append(measure('gmail.update_alerts', gmail.update_alerts, repeat, setup=reset, alerts=alerts))
+    # XOAUTH2 login against the stub token endpoint, with a cached and with an expired access token
+    gmail.OAUTH = { 'client_id': 'benchmark', 'client_secret': 'benchmark', 'refresh_token': 'benchmark', 'accounts_url': MockExchange.url }
+    gmail.ACCESS_TOKEN_FILE = 'gmail_access'
+    def login():
+        gmail.login()
+        gmail.logout()
+    def expire():
+        gmail.ACCESS_TOKEN = ('expired', 0)
+    login()
+    results.append(measure('gmail.login', login, repeat, auth='xoauth2'))
+    results.append(measure('gmail.login', login, repeat, setup=expire, auth='xoauth2-refresh'))
+    gmail.OAUTH = None
+    return results
+
+# REPORT
+
+def compare(results, baseline, threshold):
+    """ Returns the results whose mean latency increased more than threshold over the baseline """
+    key = lambda result: (result['name'], json.dumps(result['params'], sort_keys=True))
+    previous = { key(result): result for result in baseline['results'] }
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before and result['mean_ms'] > before['mean_ms'] * (1 + threshold):
+            regressions.append({ 'name': result['name'], 'params': result['params'], 'before_ms': before['mean_ms'], 'after_ms': result['mean_ms'] })
+    return regressions
+
+def sizes(s):
+    return [int(size) for size in s.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the trading hot paths")
+    parser.add_argument('--latency', type=float, default=0, help="stub exchange and IMAP latency per request (ms)")
+    parser.add_argument('--repeat', type=int, default=20, help="runs per benchmark")
+    parser.add_argument('--positions', type=sizes, default=[1, 10, 100, 500], help="portfolio sizes for equity and __str__")
+    parser.add_argument('--accounts', type=sizes, default=[10, 1000, 10000, 100000], help="account counts for load and save")
+    parser.add_argument('--alerts', type=sizes, default=[1, 10, 100], help="alert counts in the fake inbox")
+    parser.add_argument('--pairs', type=int, default=500, help="symbols served by the stub exchange")
+    parser.add_argument('--only', default=None, help="comma separated benchmarks: trade, account, persistence, ledger, list, alerts")
+    parser.add_argument('--output', default=None, help="write JSON results to this file instead of stdout")
+    parser.add_argument('--baseline', default=None, help="previous JSON results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2, help="mean latency increase reported as a regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = json.load(open(args.baseline)) if args.baseline else None
+    only = set(args.only.split(',')) if args.only else None
+    enabled = lambda name: only is None or name in only
+
+    workdir = tempfile.TemporaryDirectory(prefix='kitraderbot-benchmark-')
+    os.chdir(workdir.name)
+    os.mkdir('accounts')
+    start_stubs(args.latency / 1000, max(args.pairs, max(args.positions)))
+
+    results = []
+    if enabled('trade'):
+        results += bench_trade(args.repeat)
+    if enabled('account'):
+        results += bench_account(args.positions, args.repeat)
+    if enabled('persistence'):
+        results += bench_persistence(args.accounts, max(1, args.repeat // 10))
+    if enabled('ledger'):
+        results += bench_ledger(10000, args.repeat)
+    if enabled('list'):
+        results += bench_list_symbols(args.pairs, args.repeat)
+    if enabled('alerts'):
+        results += bench_alerts(args.alerts, args.repeat)
+
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'latency_ms': args.latency,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+    if baseline:
+        report['regressions'] = compare(results, baseline, args.threshold)
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline and report['regressions']:
+        for regression in report['regressions']:
+            print(f"Regression: {regression['name']} {regression['params']} {regression['before_ms']:.3f} ms -> {regression['after_ms']:.3f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from json import loads as json
-from requests import get
+import config
 
-BASE_URL = "https://api.binance.com"
+from api import API, BOOK_DEPTH, register, symbol_id
+
+BASE_URL = config.get('base_urls', dict()).get('Binance', "https://api.binance.com") # e.g. a local mockexchange.py
+
+FEE = 0.001
+MIN_TRADE = 10
 
 REQUESTS_LIMIT_PER_MINUTE = 1200
 REQUESTS_LIMIT_PER_SECOND = REQUESTS_LIMIT_PER_MINUTE // 60
@@ -17,43 +21,43 @@ try:
 except FileNotFoundError:
     print("Binance token not found")
 
-SUBSCRIPTION_UPDATE_SECONDS = 60
-SUBSCRIBERS = dict() # users to symbol
-
-def __get(url, callback):
-    response = get(BASE_URL + url)
-    code = response.status_code
-    if code >= 200 and code < 300:
-        return callback(json(response.content))
-    elif code >= 400 and code < 500:
-        return json(response.content).get('msg')
-    else:
-        return f"Cannot connect to Binance API: {code}"
-
-def ping():
-    return __get("/api/v1/ping", lambda _: "Binance API seems to be working.")
-
-def price(symbol):
-    symbol = symbol.upper()
-    return __get("/api/v3/ticker/price?symbol=" + symbol, lambda data: f"{symbol}: {data.get('price')}")
-
-def __exists(symbol):
-    return get(BASE_URL + "/api/v3/ticker/price?symbol=" + symbol).status_code == 200
-
-def subscription_update(user):
-    return price(SUBSCRIBERS[user]) if user in SUBSCRIBERS else "Unsubscribed."
-
-def subscribe(user, symbol):
-    symbol = symbol.upper()
-    if len(SUBSCRIBERS) >= SUBSCRIPTION_UPDATE_SECONDS * REQUESTS_LIMIT_PER_SECOND:
-        return -1, f"Sorry, cannot subscribe. Maximum subscriptors reached."
-    if not __exists(symbol):
-        return -1, "Invalid symbol."
-    SUBSCRIBERS[user] = symbol
-    return SUBSCRIPTION_UPDATE_SECONDS, f"Now you're subscribed to {symbol}, updated every minute."
-
-def unsubscribe(user):
-    if user not in SUBSCRIBERS:
-        return "Already unsubscribed."
-    SUBSCRIBERS.pop(user)
-    return "Unsubscribed successfully."
+class Binance(API):
+
+    TIMEOUTS = { '/api/v3/ping': 2, '/api/v3/ticker/price': 3, '/api/v3/ticker/price/all': 5, '/api/v3/depth': 3, '/api/v3/exchangeInfo': 10 }
+
+    def __init__(self):
+        super().__init__("Binance", BASE_URL, MIN_TRADE, FEE, REQUESTS_LIMIT_PER_MINUTE)
+
+    def symbol(self, symbol):
+        return symbol_id(symbol).upper()
+
+    def ping(self):
+        return self._get("/api/v3/ping", lambda _: "Binance API seems to be working.")
+
+    def _pairs(self, callback):
+        def pairs(data):
+            symbols = filter(lambda info: info.get('status') == 'TRADING', data.get('symbols'))
+            return callback(list(map(lambda info: (info.get('baseAsset'), info.get('quoteAsset')), symbols)))
+        return self._get("/api/v3/exchangeInfo", pairs)
+
+    def _price(self, symbol, callback):
+        def parse(data, status_code):
+            if status_code == 200:
+                return callback(data.get('price'))
+            return f"Invalid symbol: {symbol}. See /list"
+        return self._get("/api/v3/ticker/price?symbol=" + symbol, parse, filter_status=False)
+
+    def _tickers(self, callback):
+        return self._get("/api/v3/ticker/price", lambda tickers: callback({ ticker.get('symbol'): ticker.get('price') for ticker in tickers }), endpoint="/api/v3/ticker/price/all")
+
+    def _order_book(self, symbol, callback):
+        def parse(data, status_code):
+            if status_code == 200:
+                return callback(data.get('bids'), data.get('asks'))
+            return f"Invalid symbol: {symbol}. See /list"
+        return self._get(f"/api/v3/depth?symbol={symbol}&limit={BOOK_DEPTH}", parse, filter_status=False)
+
+    def exists(self, symbol):
+        return self._get("/api/v3/ticker/price?symbol=" + self.symbol(symbol), lambda _, status_code: status_code == 200, filter_status=False)
+
+BINANCE = register(Binance())
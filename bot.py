@@ -2,43 +2,103 @@
 # -*- coding: utf-8 -*-
 
 import pytz
+import time
 import logging
 import json
+import logs
 import gmail as alerts
-import bitstamp as trading
-
-from os import path
-from telegram import Bot
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from telegram.error import Unauthorized, TimedOut
+import api
+import trading
+import shards
+import config
+import metrics
+import snapshot
+import render
+import memory
+import profiler
+import webhook
+import threading
+
+from io import BytesIO
+from os import path, remove
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
+from telegram.utils.request import Request
+from telegram.error import Unauthorized, TimedOut, BadRequest
 from datetime import datetime, timedelta
 
-try:
-    with open("tokens/telegram", 'r') as telegram_token:
-        TELEGRAM_API_TOKEN = telegram_token.read().strip()
-except FileNotFoundError:
-    print("tokens/telegram not found!")
-    exit(1)
+PAIRS_REFRESH_SECONDS = 3600
+
+BOT_CONNECTIONS = 8 # Telegram connections per bot in the shared pool: polling, dispatcher workers and jobs
+
+TENANTS = list() # bots hosted by this process, the first one is the main bot
+
+class Tenant:
+    """
+    A bot hosted by this process, with its own accounts, superusers, subscriptions and auto-trading account.
+    The exchanges (quote cache, symbol index and connection pools) and the Telegram connection pool are shared.
+    """
+
+    def __init__(self, bot, superusers=(), directory='.'):
+        self.superusers = set(superusers)
+        self.directory = directory # accounts, subscriptions, lastAlert and snapshot of this bot
+        self.name = None
+        self.updater = Updater(bot=bot, use_context=True)
+        self.dispatcher = self.updater.dispatcher
+        self.dispatcher.bot_data['tenant'] = self
+        if directory == '.':
+            self.accounts, self.engine = trading.ACCOUNTS, trading # or a shards.Router when config.json sets "shards"
+        else:
+            self.accounts = trading.Accounts(path.join(directory, 'accounts'))
+            self.engine = trading.Engine(self.accounts)
+        self.subscriptions = dict() # users to job
+        self.last_update = None
+        self.new_alerts = []
+        self.updating = False
+        self.exporting = False
+
+    def file(self, name):
+        return path.join(self.directory, name)
+
+def tenant_of(context):
+    return context.bot_data['tenant']
+
+def read_config():
+    """ The main bot (tokens/telegram and superusers) and a bot per directory of "bots" in config.json """
+    directories = ['.'] + config.get('bots', [])
+    request = Request(con_pool_size=BOT_CONNECTIONS * len(directories))
+    for directory in directories:
+        token_file = "tokens/telegram" if directory == '.' else path.join(directory, 'telegram')
+        try:
+            with open(token_file, 'r') as telegram_token:
+                token = telegram_token.read().strip()
+        except FileNotFoundError:
+            print(f"{token_file} not found!")
+            exit(1)
 
-try:
-    with open("superusers", 'r') as users:
-        SUPERUSERS = set(users.read().split('\n'))
-except FileNotFoundError:
-    SUPERUSERS = set()
+        try:
+            with open(path.join(directory, 'superusers'), 'r') as users:
+                superusers = set(users.read().split('\n'))
+        except FileNotFoundError:
+            superusers = set()
+        TENANTS.append(Tenant(Bot(token, request=request), superusers, directory))
 
 def debug(update, answer):
-    print(f"{datetime.now()} - {update.message.from_user.username} ({update.message.chat_id}): {update.message.text}\n{answer}\n")
+    logs.event('message', user=update.message.from_user.username, chat_id=update.message.chat_id, text=update.message.text, answer=answer)
 
-def reply(update, text):
+def reply(update, text, markup=None):
     debug(update, text)
-    update.message.reply_text(text)
+    pages = render.paginate(text)
+    for i, page in enumerate(pages):
+        with metrics.outbound('Telegram', 'sendMessage'):
+            update.message.reply_text(page, reply_markup=markup if i == len(pages) - 1 else None)
 
-def is_superuser(update):
-    return update.message.from_user.username in SUPERUSERS
+def is_superuser(update, context):
+    return update.message.from_user.username in tenant_of(context).superusers
 
 def restricted(handler):
     def response(update, context, **kwargs):
-        if is_superuser(update):
+        if is_superuser(update, context):
             handler(update, context, **kwargs)
         else:
             reply(update, "You're not allowed to use this command.")
@@ -46,36 +106,53 @@ def restricted(handler):
 
 # BASIC AND DEFAULT HANDLERS
 
-def start(update, context):
-    user = update.message.from_user
-    superuser = is_superuser(update)
-    text = f"Hi, {user.first_name}! I'm {NAME}, your trading assistant!\n\nAvailable commands:"
+def help_text(name, superuser, username):
+    text = "Available commands:"
     # Basic commands
     text += "\n/start - Shows this message"
     text += "\n/ping - Test connection with trading API"
-    text += "\n/list - Show the available symbols"
+    text += "\n/list [page] - Show the available symbols"
     text += "\n/price symbol - Current price for provided symbol"
+    text += "\n/quote symbol - Compare the price for provided symbol in every exchange"
     # Account commands
-    text += "\n/newAccount [balance] [currency] - Creates an account for mock trading (free)"
+    text += "\n/newAccount [balance] [currency] [exchange] - Creates an account for mock trading (free)"
     text += "\n\te.g. /newAccount 1000 USD"
+    text += "\n/selectApi [exchange] - Change the exchange of your trading account"
+    text += "\n/costMethod [FIFO, LIFO, AVERAGE] - How your sells match your buys for cost basis and P&L"
     text += "\n/deleteAccount - Deletes your trading account"
     if superuser:
-        text += f"\n/account [{NAME}, {user.username}] - View your account or the bot account"
-        text += f"\n/history [{NAME}, {user.username}] - View your trades or the bot trades"
+        text += f"\n/account [{name}, {username}] - View your account or the bot account"
+        text += f"\n/history [{name}, {username}] - View your trades or the bot trades"
     else:
-        text += f"\n/account - View your account"
-        text += f"\n/history - View your trades"
+        text += "\n/account - View your account"
+        text += "\n/history - View your trades"
+    text += "\n/export - Download your trades as CSV"
     text += "\n/trade [BUY, SELL] amount symbol [comment] - Order a trade for your account"
     text += "\n\te.g. /trade BUY 0.1 ETH"
     text += "\n/tradeAll [BUY, SELL] symbol [comment] - Order a trade for your account with maximum available amount"
     text += "\n\te.g. /tradeAll BUY BTC"
-    text += f"\nTrading Fee: {trading.FEE * 100}%"
+    text += "\n/batch orders - Order many trades at once, one [BUY, SELL] [amount, ALL] symbol per line"
+    text += f"\nTrading Fees: {', '.join(f'{exchange} {exchange.fee * 100}%' for exchange in api.APIS.values())}"
     # Auto-trading commands
     if superuser:
-        text += f"\n/subscribe - Receive updates from the {NAME} auto-trading account"
-        text += f"\n/unsubscribe - Stop receiving updates from the {NAME} auto-trading account"
-        text += f"\n/update - Forces an update of the {NAME} auto-trading subscription"
-    reply(update, text)
+        text += f"\n/subscribe - Receive updates from the {name} auto-trading account"
+        text += f"\n/unsubscribe - Stop receiving updates from the {name} auto-trading account"
+        text += f"\n/update - Forces an update of the {name} auto-trading subscription"
+        text += "\n/metrics - Command latencies, outbound calls, caches and queues"
+        text += "\n/shards [restart n] - Status of the trading worker processes"
+        text += "\n/memory - Memory by subsystem and largest accounts"
+        text += "\n/exportAll - Export the trades of every account (Parquet)"
+        text += "\n/exposure - Total amount, holders and value of every held symbol"
+        text += "\n/profile [on [rate], off, reset, flame, save] - Sampling profiler of the command handlers"
+    return text
+
+def start(update, context):
+    user = update.message.from_user
+    name = tenant_of(context).name
+    superuser = is_superuser(update, context)
+    username = user.username if superuser else None # only the superuser variant names the user
+    text, _, _ = render.page(('help', name, superuser, username), lambda: help_text(name, superuser, username))
+    reply(update, f"Hi, {user.first_name}! I'm {name}, your trading assistant!\n\n{text}")
 
 def unknown(update, context):
     reply(update, f"Sorry, I didn't understand command {update.message.text}.")
@@ -94,154 +171,390 @@ def send(f, args=False):
             reply(update, f(update.message.from_user.username))
     return response
 
+def send_text(f):
+    """ Like send with args, keeping the line breaks of the message """
+    def response(update, context):
+        text = update.message.text.split(None, 1)
+        reply(update, f(update.message.from_user.username, text[1] if len(text) > 1 else ''))
+    return response
+
+def list_keyboard(page, pages):
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Previous", callback_data=f"list {page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"list {page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data=f"list {page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+def list_symbols(update, context):
+    page = int(context.args[0]) - 1 if context.args and context.args[0].isdigit() else 0
+    text, page, pages = tenant_of(context).engine.list_symbols(update.message.from_user.username, page)
+    reply(update, text, list_keyboard(page, pages))
+
+def list_page(update, context):
+    """ Inline keyboard navigation of /list, editing the listing message in place """
+    query = update.callback_query
+    query.answer()
+    text, page, pages = tenant_of(context).engine.list_symbols(query.from_user.username, int(query.data.split()[1]))
+    try:
+        with metrics.outbound('Telegram', 'editMessageText'):
+            query.edit_message_text(text, reply_markup=list_keyboard(page, pages))
+    except BadRequest: # message is not modified, e.g. the current page button
+        pass
+
+def show_metrics(update, context):
+    reply(update, metrics.summary())
+
+def show_memory(update, context):
+    reply(update, tenant_of(context).engine.memory())
+
+PROFILE_SYNTAX = "/profile [on [rate], off, reset, flame, save]\n\ne.g. /profile on 0.25 to sample 25% of the commands"
+
+def profile(update, context):
+    """ Control the sampling profiler, show its top functions or send its collapsed stacks """
+    action = context.args[0].lower() if context.args else ''
+    if action == 'on':
+        try:
+            sample_rate = float(context.args[1]) if len(context.args) > 1 else profiler.SAMPLE_RATE
+        except ValueError:
+            return reply(update, PROFILE_SYNTAX)
+        profiler.start(sample_rate)
+    elif action == 'off':
+        profiler.stop()
+    elif action == 'reset':
+        profiler.reset()
+    elif action == 'flame':
+        stacks = profiler.collapsed()
+        if not stacks:
+            return reply(update, "No samples yet, use /profile on")
+        with metrics.outbound('Telegram', 'sendDocument'):
+            update.message.reply_document(BytesIO(stacks.encode('utf-8')), filename='profile.folded',
+                caption="Collapsed stacks, render with flamegraph.pl or speedscope.app")
+        return
+    elif action == 'save':
+        return reply(update, f"Saved to {profiler.save()}")
+    elif action:
+        return reply(update, PROFILE_SYNTAX)
+    reply(update, profiler.summary())
+
+def export_trades(update, context):
+    username = update.message.from_user.username
+    file, error = tenant_of(context).engine.export_csv(username)
+    if error:
+        return reply(update, error)
+    try:
+        with open(file, 'rb') as csv_file, metrics.outbound('Telegram', 'sendDocument'):
+            update.message.reply_document(csv_file, filename=f"{username}-trades.csv", caption="Your trades, one row per fill")
+    finally:
+        remove(file)
+
+def export_all(update, context):
+    """ Export in the background, the dispatcher keeps serving commands meanwhile """
+    tenant = tenant_of(context)
+    if tenant.exporting:
+        return reply(update, "An export is already running, I will reply when it finishes.")
+    tenant.exporting = True
+    reply(update, "Exporting. I will reply with the file when it finishes.")
+    context.job_queue.run_once(lambda job_context: export_job(tenant, update), 0, name='exportAll')
+
+def export_job(tenant, update):
+    try:
+        text = tenant.engine.export_all()
+    except Exception as e:
+        logs.event('export_failed', level=logging.ERROR, error=str(e))
+        text = "Sorry, the export failed. Please, try again."
+    finally:
+        tenant.exporting = False
+    reply(update, text)
+
+def show_exposure(update, context):
+    reply(update, tenant_of(context).engine.exposure())
+
+def show_shards(update, context):
+    engine = tenant_of(context).engine
+    if not isinstance(engine, shards.Router):
+        return reply(update, "Sharding is disabled.")
+    if len(context.args) == 2 and context.args[0] == 'restart' and context.args[1].isdigit() and int(context.args[1]) < len(engine.shards):
+        engine.restart(int(context.args[1]))
+    reply(update, engine.status())
+
 def account(f):
     def response(update, context):
-        reply(update, f(NAME, update.message.from_user.username, is_superuser(update), ' '.join(context.args)))
+        reply(update, f(tenant_of(context).name, update.message.from_user.username, is_superuser(update, context), ' '.join(context.args)))
     return response
 
 # SUBSCRIPTIONS
 
-SUBSCRIPTIONS = dict() # users to job
-
 UPDATE_ALERTS_SECONDS = 900
 
-lastUpdate = alerts.get_last_alert_date() or datetime.now(pytz.UTC) - timedelta(hours=24)
-newAlerts = []
-updating = False
-
-def update_alerts(force=False):
-    global lastUpdate, newAlerts, updating
-    if updating or not alerts.ENABLED:
+def update_alerts(tenant, force=False):
+    if tenant.updating or not alerts.ENABLED:
         return
-    updating = True
+    tenant.updating = True
     now = datetime.now(pytz.UTC)
-    newAlerts = []
-    if force or lastUpdate < now - timedelta(seconds=UPDATE_ALERTS_SECONDS // 2):
+    tenant.new_alerts = []
+    if force or tenant.last_update < now - timedelta(seconds=UPDATE_ALERTS_SECONDS // 2):
         try:
-            newAlerts = alerts.update_alerts()
-            lastUpdate = now
+            tenant.new_alerts = alerts.update_alerts(file=tenant.file('lastAlert'))
+            tenant.last_update = now
         except Exception:
-            logging.exception("Cannot update alerts")
-    updating = False
-
-def subscription_update(bot, chat_id, force=False):
-    update_alerts(force)
-    for _, newAlertText in newAlerts:
-        if not trading.existsAccount(NAME):
-            trading.newAccount(NAME)
-        result = trading.tradeAll(NAME, newAlertText)
+            logs.exception('alerts_update_failed', bot=tenant.name)
+    tenant.updating = False
+
+def subscription_update(tenant, bot, chat_id, force=False):
+    update_alerts(tenant, force)
+    engine = tenant.engine
+    for _, newAlertText in tenant.new_alerts:
+        if not engine.existsAccount(tenant.name):
+            engine.newAccount(tenant.name)
+        result = engine.tradeAll(tenant.name, newAlertText)
         if 'BUY' not in result and 'SELL' not in result:
             result = newAlertText + '\n' + result
         text = f"🚨 New Alert!\n\n{result}"
-        print(text)
-        bot.send_message(chat_id=chat_id, text=text)
+        logs.event('alert', chat_id=chat_id, text=text)
+        with metrics.outbound('Telegram', 'sendMessage'):
+            bot.send_message(chat_id=chat_id, text=text)
 
 def subscription_job(context):
-    subscription_update(context.bot, chat_id=context.job.context)
+    profiler.profiled('subscription', subscription_update)(tenant_of(context), context.bot, chat_id=context.job.context)
 
 def force_update(update, context):
     if not alerts.ENABLED:
         reply(update, "Alerts are disabled.")
         return
     reply(update, "Updating. Please, wait a few seconds.")
-    subscription_update(context.bot, update.message.chat_id, force=True)
-    if not newAlerts:
+    tenant = tenant_of(context)
+    subscription_update(tenant, context.bot, update.message.chat_id, force=True)
+    if not tenant.new_alerts:
         reply(update, "Alerts are up to date.")
 
-def loadSubscriptions():
-    global updater
-    if path.isfile('subscriptions'):
-        with open('subscriptions', 'r') as subscriptionsFile:
-            subscriptionUsers = json.load(subscriptionsFile)
-            for subscriber in subscriptionUsers:
-                job = updater.job_queue.run_repeating(subscription_job, interval=UPDATE_ALERTS_SECONDS, first=30, context=subscriber['chat_id'])
-                SUBSCRIPTIONS[subscriber['user']] = job
+def subscriptions(tenant):
+    return [{ 'user': user, 'chat_id': job.context } for user, job in tenant.subscriptions.items()]
+
+def scheduleSubscriptions(tenant, subscriptionUsers):
+    for subscriber in subscriptionUsers:
+        job = tenant.updater.job_queue.run_repeating(subscription_job, interval=UPDATE_ALERTS_SECONDS, first=30, context=subscriber['chat_id'])
+        tenant.subscriptions[subscriber['user']] = job
 
-def saveSubscriptions():
-    with open('subscriptions', 'w') as subscriptionsFile:
-        json.dump([{ 'user': user, 'chat_id': job.context } for user, job in SUBSCRIPTIONS.items()], subscriptionsFile)
+def loadSubscriptions(tenant):
+    if path.isfile(tenant.file('subscriptions')):
+        with open(tenant.file('subscriptions'), 'r') as subscriptionsFile:
+            scheduleSubscriptions(tenant, json.load(subscriptionsFile))
+
+def saveSubscriptions(tenant):
+    with open(tenant.file('subscriptions'), 'w') as subscriptionsFile:
+        json.dump(subscriptions(tenant), subscriptionsFile)
 
 def subscribe(update, context):
     user = update.message.from_user.username
-    if user not in SUBSCRIPTIONS:
+    tenant = tenant_of(context)
+    if user not in tenant.subscriptions:
         job = context.job_queue.run_repeating(subscription_job, interval=UPDATE_ALERTS_SECONDS, first=0, context=update.message.chat_id)
-        SUBSCRIPTIONS[user] = job
-        reply(update, f"Now you are subscribed to {NAME} trades.")
+        tenant.subscriptions[user] = job
+        reply(update, f"Now you are subscribed to {tenant.name} trades.")
     else:
         reply(update, "Already subscribed.")
 
-def __unsubscribe(update):
-    user = update.message.from_user.username
-    if user in SUBSCRIPTIONS:
-        SUBSCRIPTIONS[user].schedule_removal()
-        SUBSCRIPTIONS.pop(user)
+def __unsubscribe(update, context):
+    user = update.effective_user.username
+    subscriptions = tenant_of(context).subscriptions
+    if user in subscriptions:
+        subscriptions[user].schedule_removal()
+        subscriptions.pop(user)
         return "Unsubscribed successfully."
     else:
         return "You are not subscribed."
 
 def unsubscribe(update, context):
-    reply(update, __unsubscribe(update))
-
-# INITIALIZATION
-print("Starting bot...")
-
-bot = Bot(TELEGRAM_API_TOKEN)
-NAME = bot.get_me().first_name
-updater = Updater(TELEGRAM_API_TOKEN, use_context=True)
-dispatcher = updater.dispatcher
+    reply(update, __unsubscribe(update, context))
 
 # ERROR HANDLING
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARN)
 
 def error_callback(update, context):
     try:
         raise context.error
     except Unauthorized:
-        __unsubscribe(update)
+        __unsubscribe(update, context)
     except TimedOut:
         pass
 
-print('Adding command handlers...')
-
-dispatcher.add_error_handler(error_callback)
-
-# TRADING HANDLERS
-dispatcher.add_handler(CommandHandler('ping', wrap(trading.ping)))
-dispatcher.add_handler(CommandHandler('price', send(trading.price, args=True)))
-dispatcher.add_handler(CommandHandler('list', send(trading.list_symbols)))
-dispatcher.add_handler(CommandHandler('account', account(trading.account)))
-dispatcher.add_handler(CommandHandler('history', account(trading.history)))
-dispatcher.add_handler(CommandHandler('trade', send(trading.trade, args=True)))
-dispatcher.add_handler(CommandHandler('tradeAll', send(trading.tradeAll, args=True)))
-dispatcher.add_handler(CommandHandler('newAccount', send(trading.newAccount, args=True)))
-dispatcher.add_handler(CommandHandler('deleteAccount', send(trading.deleteAccount)))
-dispatcher.add_handler(CommandHandler('subscribe', restricted(subscribe), pass_job_queue=True))
-dispatcher.add_handler(CommandHandler('unsubscribe', restricted(unsubscribe)))
-dispatcher.add_handler(CommandHandler('update', restricted(force_update)))
-
-# TODO: Command /selectApi [Bitstamp | Binance]
-
-# DEFAULT HANDLERS
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(MessageHandler(Filters.command, unknown))
-dispatcher.add_handler(MessageHandler(Filters.text, start))
-
-# START
-print('Loading trading API...')
-trading.load()
-
-print('Loading subscriptions...')
-loadSubscriptions()
-
-updater.start_polling()
-
-print(f"\n{NAME} Started!\n")
-
-updater.idle()
-
-# STOP
-print("Saving accounts...")
-trading.save()
-saveSubscriptions()
+def instrument(name, handler):
+    timed = metrics.command(name)(profiler.profiled(name, handler))
+    def response(update, context, **kwargs):
+        start = time.perf_counter()
+        try:
+            timed(update, context, **kwargs)
+        finally:
+            logs.event('command', command=name, bot=tenant_of(context).name, user=update.effective_user.username, chat_id=update.effective_chat.id, duration_ms=round((time.perf_counter() - start) * 1000, 3))
+    return response
 
-print("Done! Goodbye!")
+def add_command(dispatcher, name, handler, **kwargs):
+    dispatcher.add_handler(CommandHandler(name, instrument(name, handler), **kwargs))
+
+def add_handlers(tenant):
+    dispatcher, engine = tenant.dispatcher, tenant.engine
+    dispatcher.add_error_handler(error_callback)
+
+    # TRADING HANDLERS
+    add_command(dispatcher, 'ping', wrap(engine.ping))
+    add_command(dispatcher, 'price', send(engine.price, args=True))
+    add_command(dispatcher, 'quote', send(engine.quote, args=True))
+    add_command(dispatcher, 'list', list_symbols)
+    add_command(dispatcher, 'account', account(engine.account))
+    add_command(dispatcher, 'history', account(engine.history))
+    add_command(dispatcher, 'trade', send(engine.trade, args=True))
+    add_command(dispatcher, 'tradeAll', send(engine.tradeAll, args=True))
+    add_command(dispatcher, 'batch', send_text(engine.batch))
+    add_command(dispatcher, 'newAccount', send(engine.newAccount, args=True))
+    add_command(dispatcher, 'deleteAccount', send(engine.deleteAccount))
+    add_command(dispatcher, 'selectApi', send(engine.selectApi, args=True))
+    add_command(dispatcher, 'costMethod', send(engine.costMethod, args=True))
+    add_command(dispatcher, 'subscribe', restricted(subscribe), pass_job_queue=True)
+    add_command(dispatcher, 'unsubscribe', restricted(unsubscribe))
+    add_command(dispatcher, 'update', restricted(force_update))
+    add_command(dispatcher, 'metrics', restricted(show_metrics))
+    add_command(dispatcher, 'shards', restricted(show_shards))
+    add_command(dispatcher, 'memory', restricted(show_memory))
+    add_command(dispatcher, 'export', export_trades)
+    add_command(dispatcher, 'exportAll', restricted(export_all))
+    add_command(dispatcher, 'exposure', restricted(show_exposure))
+    add_command(dispatcher, 'profile', restricted(profile))
+
+    dispatcher.add_handler(CallbackQueryHandler(instrument('list_page', list_page), pattern=r'^list \d+$'))
+
+    # DEFAULT HANDLERS
+    add_command(dispatcher, 'start', start)
+    dispatcher.add_handler(MessageHandler(Filters.command, instrument('unknown', unknown)))
+    dispatcher.add_handler(MessageHandler(Filters.text, instrument('text', start)))
+
+# UPDATES
+
+def start_webhook(tenant, settings, server=None):
+    """
+    Receive the updates of a tenant on the local webhook server instead of polling, registering settings['url'] if given.
+    The main bot starts the server on settings['path'], other bots are served on the same server at path/directory.
+    """
+    suffix = '' if tenant.directory == '.' else '/' + path.basename(path.normpath(tenant.directory))
+    bot, queue = tenant.updater.bot, tenant.dispatcher.update_queue
+    if server is None:
+        server = webhook.serve(bot, queue, webhook.read_secret(),
+            settings.get('host', webhook.HOST), settings.get('port', webhook.PORT), settings.get('path', webhook.PATH) + suffix)
+    else:
+        webhook.route(server, bot, queue, settings.get('path', webhook.PATH) + suffix)
+    if settings.get('url'):
+        bot.set_webhook(url=settings['url'] + suffix, secret_token=server.RequestHandlerClass.secret, max_connections=settings.get('max_connections', 40))
+    tenant.updater.job_queue.start()
+    threading.Thread(target=tenant.dispatcher.start, name=f'dispatcher {tenant.name}', daemon=True).start()
+    tenant.updater.running = True # idle() and stop() stop the dispatcher and job queue
+    return server
+
+# STATE
+
+def restore(tenant):
+    """ Restore the warm-start snapshot of a tenant, returns False if there is none """
+    state = snapshot.load(tenant.file(snapshot.FILE))
+    if state is None:
+        return False
+    tenant.name = state['name']
+    tenant.last_update = state['last_update']
+    if not isinstance(tenant.engine, shards.Router):
+        tenant.accounts.update(state['accounts'])
+        tenant.accounts.exposure.restore(state['exposure'])
+    for name, pairs in state['pairs'].items():
+        exchange = api.get_api(name)
+        if exchange is not None and exchange.pairs is None: # shared by every tenant
+            exchange.set_pairs(pairs)
+    scheduleSubscriptions(tenant, state['subscriptions'])
+    return True
+
+def save(tenant):
+    tenant.engine.save()
+    saveSubscriptions(tenant)
+    snapshot.save({
+        'name': tenant.name,
+        'last_update': tenant.last_update,
+        'accounts': dict(tenant.accounts),
+        'exposure': tenant.accounts.exposure.totals(),
+        'pairs': { exchange.name: exchange.pairs for exchange in api.APIS.values() if exchange.pairs },
+        'subscriptions': subscriptions(tenant)
+    }, tenant.file(snapshot.FILE))
+
+def main():
+    # INITIALIZATION
+    started = time.perf_counter()
+    print("Starting bot...")
+    if config.get('tracemalloc'):
+        memory.start()
+    if config.get('profile_sample_rate'):
+        profiler.start(config.get('profile_sample_rate'))
+    logs.setup()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARN)
+    read_config()
+    main_bot = TENANTS[0]
+
+    if config.get('shards', 0) > 0: # other bots trade in this process
+        main_bot.engine = shards.Router(config.get('shards'))
+
+    print('Adding command handlers...')
+    for tenant in TENANTS:
+        add_handlers(tenant)
+
+    # START
+    print('Loading state...')
+    for tenant in TENANTS:
+        restored = restore(tenant)
+        with trading.using(tenant.accounts): # shards index the exposure of their own users
+            trading.load(lazy=True, owns=(lambda user: False) if isinstance(tenant.engine, shards.Router) else None, indexed=restored)
+        if restored:
+            print(f'Restored warm-start snapshot of {tenant.name}')
+        else:
+            tenant.name = tenant.updater.bot.get_me().first_name
+            tenant.last_update = alerts.get_last_alert_date(tenant.file('lastAlert')) or datetime.now(pytz.UTC) - timedelta(hours=24)
+            loadSubscriptions(tenant)
+        if isinstance(tenant.engine, shards.Router):
+            tenant.engine.start()
+    alerts.start_refresher()
+    # the symbol index is shared, the main bot refreshes it for every bot
+    main_bot.updater.job_queue.run_repeating(lambda context: main_bot.engine.refresh_pairs(), interval=PAIRS_REFRESH_SECONDS, first=PAIRS_REFRESH_SECONDS)
+
+    print(f'Serving metrics on {metrics.HOST}:{metrics.PORT}...')
+    for tenant in TENANTS:
+        metrics.gauge('queue_depth', tenant.dispatcher.update_queue.qsize, queue='updates', bot=tenant.name)
+        metrics.gauge('queue_depth', lambda tenant=tenant: len(tenant.updater.job_queue.jobs()), queue='jobs', bot=tenant.name)
+    metrics.serve()
+
+    server = None
+    for tenant in TENANTS:
+        if config.get('updates', 'polling') == 'webhook':
+            settings = config.get('webhook', dict())
+            server = start_webhook(tenant, settings, server)
+            print(f"Receiving {tenant.name} updates on {server.server_address[0]}:{server.server_address[1]}...")
+        else:
+            tenant.updater.start_polling()
+
+    names = ', '.join(tenant.name for tenant in TENANTS)
+    logs.event('started', name=names, bots=len(TENANTS), seconds=round(time.perf_counter() - started, 3))
+    print(f"\n{names} Started!\n")
+
+    main_bot.updater.idle()
+
+    # STOP
+    for tenant in TENANTS[1:]:
+        tenant.updater.stop()
+    alerts.stop_refresher()
+    if server is not None:
+        server.shutdown()
+    print("Saving accounts...")
+    for tenant in TENANTS:
+        save(tenant)
+        if isinstance(tenant.engine, shards.Router):
+            tenant.engine.stop()
+
+    print("Done! Goodbye!")
+    logs.stop()
+
+if __name__ == '__main__':
+    main()
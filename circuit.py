@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breaker for outbound calls.
+
+After FAILURE_THRESHOLD consecutive failures the circuit opens and calls fail fast for RESET_SECONDS.
+Then a single trial call is let through (half-open): its success closes the circuit, its failure opens it again.
+"""
+
+import time
+import logs
+import logging
+import threading
+
+FAILURE_THRESHOLD = 5
+RESET_SECONDS = 30
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0 # monotonic time the circuit opened
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Test if a call may be made now, letting one trial call through once the reset time elapsed """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened >= self.reset_seconds:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def is_open(self):
+        return self.state != CLOSED
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logs.event('circuit_closed', circuit=self.name)
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened = time.monotonic()
+                logs.event('circuit_opened', level=logging.WARNING, circuit=self.name, failures=self.failures)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional runtime settings read from config.json, e.g. { "shards": 4 }
+"""
+
+import json
+
+FILE = 'config.json'
+
+try:
+    with open(FILE, 'r') as config_file:
+        SETTINGS = json.load(config_file)
+except FileNotFoundError:
+    SETTINGS = dict()
+
+def get(key, default=None):
+    return SETTINGS.get(key, default)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+Currency conversion over the pairs of an exchange.
+
+The symbol index of an exchange is a graph of currencies joined by its pairs. A symbol converts to a currency along
+the route with the fewest hops (the direct pair when it is listed), cached until the symbol index changes. The rate of
+a route is the product of the cached quotes of its pairs, cached until one of them ticks. Quotes are refreshed in
+batch: one request for every pair of every route needed by a valuation.
+"""
+
+import sys
+import api
+import time
+import money
+import threading
+
+from collections import deque
+from fractions import Fraction
+
+LOCK = threading.Lock()
+
+GRAPHS = dict() # exchange name to currency to list of (currency, pair symbol, inverted)
+
+ROUTES = dict() # (exchange name, source, target) to route: tuple of (pair symbol, inverted), None if unreachable
+
+RATES = dict() # (exchange name, route) to rate in price units
+
+DEPENDENTS = dict() # (exchange name, pair symbol) to the cached routes using the pair
+
+def __graph(exchange):
+    graph = GRAPHS.get(exchange.name)
+    if graph is None:
+        graph = dict()
+        for base, quote in exchange.pairs:
+            base, quote = base.upper(), quote.upper()
+            pair = sys.intern(exchange.symbol(base + quote))
+            graph.setdefault(base, []).append((quote, pair, False))
+            graph.setdefault(quote, []).append((base, pair, True))
+        GRAPHS[exchange.name] = graph
+    return graph
+
+def __search(graph, source, target):
+    """ Breadth-first search of the route with the fewest hops """
+    previous = { source: None }
+    queue = deque([source])
+    while queue:
+        currency = queue.popleft()
+        if currency == target:
+            route = []
+            while previous[currency]:
+                currency, pair, inverted = previous[currency]
+                route.append((pair, inverted))
+            return tuple(reversed(route))
+        for neighbour, pair, inverted in graph.get(currency, ()):
+            if neighbour not in previous:
+                previous[neighbour] = (currency, pair, inverted)
+                queue.append(neighbour)
+    return None
+
+def route(exchange, source, target):
+    """ Route converting source to target on exchange, () if they are the same currency, None if there is none """
+    source, target = source.upper(), target.upper()
+    key = (exchange.name, source, target)
+    if key in ROUTES:
+        return ROUTES[key]
+    if exchange.pairs is None and not isinstance(exchange.refresh_pairs(), list):
+        return ((exchange.symbol(source + target), False),) # no symbol index, assume the direct pair (not cached)
+    with LOCK:
+        found = ROUTES[key] = __search(__graph(exchange), source, target)
+        for pair, _ in found or ():
+            DEPENDENTS.setdefault((exchange.name, pair), set()).add(found)
+    return found
+
+def routes(exchange, symbols, currency):
+    """ Route of every symbol to currency, raises ValueError if a symbol has none """
+    found = dict()
+    for symbol in symbols:
+        found[symbol] = route(exchange, symbol, currency)
+        if found[symbol] is None:
+            raise ValueError(f"{symbol} cannot be converted to {currency} on {exchange}.")
+    return found
+
+def refresh(exchange, routes, max_age=api.QUOTE_TTL_SECONDS):
+    """ Refresh the quotes older than max_age of every pair in routes, with a single request when many are old """
+    now = time.monotonic()
+    pairs = set(pair for route in routes for pair, _ in route)
+    old = [pair for pair in pairs if pair not in exchange.quotes or now - exchange.quotes[pair][1] >= max_age]
+    if len(old) > 1 and isinstance(exchange.get_prices(old), dict):
+        return
+    for pair in old: # a single pair, or the batch failed: stale prices may still be served one by one
+        current = exchange.get_price(pair, max_age=max_age)
+        if not isinstance(current, float):
+            raise ValueError(current)
+
+def rate(exchange, route):
+    """ Rate of a route in price units from the cached quotes """
+    key = (exchange.name, route)
+    cached = RATES.get(key)
+    if cached is None:
+        product = Fraction(1)
+        for pair, inverted in route:
+            current = Fraction(exchange.quotes[pair][0])
+            product = product / current if inverted else product * current
+        cached = RATES[key] = money.price(product)
+    return cached
+
+def rates(exchange, routes):
+    """ Rates of many routes from one snapshot: their quotes are refreshed in batch first """
+    refresh(exchange, routes)
+    return { route: rate(exchange, route) for route in routes }
+
+def tick(exchange, pair, price):
+    for route in tuple(DEPENDENTS.get((exchange.name, pair), ())):
+        RATES.pop((exchange.name, route), None)
+
+def pairs_changed(exchange):
+    with LOCK:
+        GRAPHS.pop(exchange.name, None)
+        for cache in (ROUTES, DEPENDENTS, RATES):
+            for key in [key for key in cache if key[0] == exchange.name]:
+                del cache[key]
+
+api.TICK_LISTENERS.append(tick)
+api.PAIRS_LISTENERS.append(pairs_changed)
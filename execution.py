@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Depth-aware fills.
+
+An order walks the levels of an order book snapshot, best first, and fills at the volume-weighted average price (VWAP)
+of the amounts it takes from each level. Slippage is the distance from the VWAP to the best level.
+"""
+
+import money
+
+from fractions import Fraction
+
+class Fill:
+
+    __slots__ = ('amount', 'price', 'best', 'levels')
+
+    def __init__(self, amount, price, best, levels):
+        self.amount = amount # units of the base symbol
+        self.price = price # VWAP in price units
+        self.best = best # best level in price units
+        self.levels = levels # levels consumed
+
+    def slippage(self):
+        """ Distance from the VWAP to the best level in percent, positive when the fill is worse than the best level """
+        return abs(self.price - self.best) * 100 / self.best
+
+    def current(self):
+        """ VWAP as an exact quote, accepted by the Account trade methods """
+        return Fraction(self.price, 10 ** money.PRICE_SCALE)
+
+    def __str__(self):
+        return f"VWAP of {self.levels} level{'s' if self.levels > 1 else ''}, best {money.fmt(self.best, '', 7, money.PRICE_SCALE)}, slippage {self.slippage():.3f}%"
+
+def walk(levels, base, quote, amount=None, budget=None, up=False):
+    """
+    Fill an amount of base units, or as much as budget quote units buy, from book levels (see api.Book)
+
+    up: round the VWAP up (BUY) instead of down (SELL)
+    returns: Fill, None if the levels are not deep enough for amount
+    """
+    if not levels:
+        return None
+    remaining = amount
+    filled = notional = used = 0
+    for current, available in levels:
+        available = available * 10 ** money.scale(base) // 10 ** money.PRICE_SCALE # book amounts have PRICE_SCALE digits
+        if budget is not None:
+            take = min(available, money.affordable(budget, quote, current, base))
+            budget -= money.cost(take, base, current, quote, up=True)
+        else:
+            take = min(available, remaining)
+            remaining -= take
+        if take:
+            filled += take
+            notional += take * current
+            used += 1
+        if take < available or remaining == 0:
+            break
+    else: # every level consumed
+        if remaining or (budget is not None and money.affordable(budget, quote, current, base)):
+            return None
+    if filled == 0:
+        return None
+    price = -(-notional // filled) if up else notional // filled
+    return Fill(filled, price, levels[0][0], used)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Trade history export.
+
+Trade records are parsed one at a time into rows by generators, so an export holds a single record (and, for the
+columnar format, a single row group) in memory whatever the size of the history:
+
+- CSV of one account, sent as a Telegram document by /export
+- Parquet of every account (/exportAll or python3 export.py), or gzipped CSV when pyarrow is not installed
+
+    python3 export.py exports/trades.parquet
+"""
+
+import os
+import re
+import csv
+import sys
+import gzip
+import tempfile
+
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ('user', 'date', 'batch', 'action', 'symbol', 'amount', 'price', 'cost', 'fee', 'realized', 'currency', 'equity', 'detail', 'comment')
+
+ROW_GROUP_ROWS = 65536 # rows per Parquet row group, the memory bound of a bulk export
+
+DIRECTORY = 'exports'
+
+FILL = re.compile(r"^\S+ (BUY|SELL) (\S+) (\S+) at (\S+) (\S+) for (\S+) \S+ with (\S+) \S+ fees\.$")
+
+def trades(user, historic):
+    """ Rows (in COLUMNS order) of the fills of every trade record, records that cannot be parsed are skipped """
+    for batch, record in enumerate(historic):
+        lines = (record.decode('utf-8') if isinstance(record, bytes) else record).split('\n')
+        fills, equity, comment = [], None, ''
+        for line in lines[1:]:
+            match = FILL.match(line)
+            if match:
+                fills.append([*match.groups(), None, ''])
+            elif line.startswith('Equity: '):
+                equity = line[len('Equity: '):].split(' ', 1)[0]
+            elif line.startswith('Realized P&L: ') and fills:
+                fills[-1][-2] = line[len('Realized P&L: '):].split(' ', 1)[0]
+            elif line.startswith('Comment: '):
+                comment = line[len('Comment: '):]
+            elif fills and not line.startswith('📦'):
+                fills[-1][-1] = line # fill detail, e.g. the VWAP of the order book levels
+        for action, amount, symbol, price, currency, cost, fee, realized, detail in fills:
+            yield (user, lines[0], batch if len(fills) > 1 else None, action, symbol, amount, price, cost, fee, realized, currency, equity, detail, comment)
+
+def rows(accounts):
+    """ Rows of the trades of every account, accounts: iterable of Account """
+    for account in accounts:
+        yield from trades(account.user, account.historic)
+
+def write_csv(rows, stream):
+    writer = csv.writer(stream)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+def account_csv(account, directory=None):
+    """ Path of a new CSV file with the trades of an account, the caller removes it """
+    os.makedirs(directory or DIRECTORY, exist_ok=True)
+    handle, path = tempfile.mkstemp(prefix=f"{account.user}-", suffix='.csv', dir=directory or DIRECTORY)
+    with os.fdopen(handle, 'w', newline='', encoding='utf-8') as csv_file:
+        write_csv(trades(account.user, account.historic), csv_file)
+    return path
+
+def __decimal(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def __row_groups(rows):
+    """ Columns (lists of values) of ROW_GROUP_ROWS rows at a time """
+    group = [[] for _ in COLUMNS]
+    for row in rows:
+        for column, value in zip(group, row):
+            column.append(value)
+        if len(group[0]) >= ROW_GROUP_ROWS:
+            yield group
+            group = [[] for _ in COLUMNS]
+    if group[0]:
+        yield group
+
+def __parquet(rows, path):
+    decimals = ('amount', 'price', 'cost', 'fee', 'realized', 'equity')
+    schema = pyarrow.schema([(column, pyarrow.int64() if column == 'batch' else pyarrow.float64() if column in decimals else pyarrow.string()) for column in COLUMNS])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+        for group in __row_groups(rows):
+            columns = [list(map(__decimal, values)) if column in decimals else values for column, values in zip(COLUMNS, group)]
+            writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            count += len(group[0])
+    return count
+
+def bulk(accounts, path=None):
+    """
+    Export the trades of every account (an iterable, consumed once) to path, Parquet if pyarrow is installed and
+    gzipped CSV otherwise. Returns (path, rows).
+    """
+    extension = '.parquet' if pyarrow else '.csv.gz'
+    if path is None:
+        os.makedirs(DIRECTORY, exist_ok=True)
+        path = os.path.join(DIRECTORY, f"trades-{datetime.now().strftime('%Y%m%d-%H%M%S')}{extension}")
+    elif not path.endswith(extension):
+        path += extension
+    tmp = path + '.tmp'
+    if pyarrow:
+        count = __parquet(rows(accounts), tmp)
+    else:
+        with gzip.open(tmp, 'wt', newline='', encoding='utf-8') as csv_file:
+            count = write_csv(rows(accounts), csv_file)
+    os.replace(tmp, path)
+    return path, count
+
+if __name__ == '__main__':
+    # Export every account of accounts/: python3 export.py [path]
+    from account import Account
+    accounts = (Account.load(os.path.join('accounts', user)) for user in sorted(os.listdir('accounts')))
+    path, count = bulk(accounts, sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"{count} trades exported to {path}")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Aggregate exposure of every account, by symbol.
+
+Each tenant's accounts have an Index of the total amount and the number of holders of each symbol. Accounts report
+every position change to the index of the accounts they belong to as it happens (O(1) per trade), and the index is
+restored from the snapshot on startup (rebuilt from the account files without one), so /exposure never scans the
+accounts. Notional values are computed when
+reported, from one price snapshot of the held symbols.
+"""
+
+import api
+import money
+import threading
+import conversion
+
+REPORT_CURRENCY = 'USD'
+
+class Index:
+    """ SYMBOL to [total amount in units, holders] of the accounts of a tenant (see trading.Accounts) """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.symbols = dict()
+
+    def change(self, symbol, previous, amount):
+        """ A position of symbol changed from previous to amount units """
+        if previous == amount:
+            return
+        with self.lock:
+            entry = self.symbols.setdefault(symbol, [0, 0])
+            entry[0] += amount - previous
+            entry[1] += (amount > 0) - (previous > 0)
+            if entry[1] <= 0:
+                del self.symbols[symbol]
+
+    def add(self, account):
+        for symbol, amount in account.positions.items():
+            self.change(symbol, 0, amount)
+
+    def remove(self, account):
+        for symbol, amount in account.positions.items():
+            self.change(symbol, amount, 0)
+
+    def clear(self):
+        with self.lock:
+            self.symbols.clear()
+
+    def restore(self, totals):
+        """ Replace the index with totals, e.g. from a snapshot """
+        with self.lock:
+            self.symbols = { symbol: list(entry) for symbol, entry in totals.items() }
+
+    def totals(self):
+        """ Copy of the index: SYMBOL to (total amount in units, holders) """
+        with self.lock:
+            return { symbol: tuple(entry) for symbol, entry in self.symbols.items() }
+
+def merge(indexes):
+    """ Sum of many totals, e.g. of every shard """
+    merged = dict()
+    for index in indexes:
+        for symbol, (amount, holders) in index.items():
+            total = merged.get(symbol, (0, 0))
+            merged[symbol] = (total[0] + amount, total[1] + holders)
+    return merged
+
+def notional(index, currency=REPORT_CURRENCY):
+    """ SYMBOL to value of its total amount in units of currency (None if it has no price), from one snapshot """
+    exchange = api.get_api(api.DEFAULT)
+    routes = { symbol: conversion.route(exchange, symbol, currency) for symbol in index }
+    try:
+        rates = conversion.rates(exchange, set(route for route in routes.values() if route is not None))
+    except (ValueError, KeyError):
+        rates = dict()
+    return { symbol: money.cost(index[symbol][0], symbol, rates[route], currency) if route in rates else None for symbol, route in routes.items() }
+
+def report(index, top=30, currency=REPORT_CURRENCY):
+    """ Exposure by symbol as a message, largest notional first """
+    if not index:
+        return "No open positions."
+    values = notional(index, currency)
+    ranked = sorted(index, key=lambda symbol: (values[symbol] is not None, values[symbol] or 0, index[symbol][0]), reverse=True)
+    text = f"Exposure: {len(index)} symbols, {sum(holders for _, holders in index.values())} positions"
+    priced = [value for value in values.values() if value is not None]
+    text += f"\nTotal: {money.fmt(sum(priced), currency, 2)} {currency}"
+    text += f" ({len(values) - len(priced)} symbols without price)\n" if len(priced) < len(values) else "\n"
+    for symbol in ranked[:top]:
+        amount, holders = index[symbol]
+        value = f"{money.fmt(values[symbol], currency, 2)} {currency}" if values[symbol] is not None else "no price"
+        text += f"\n{symbol}: {money.fmt(amount, symbol, 7)} ({holders} holder{'s' if holders > 1 else ''}), {value}"
+    if len(ranked) > top:
+        text += f"\n\n{len(ranked) - top} more symbols"
+    return text
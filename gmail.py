@@ -1,9 +1,16 @@
 import os
+import json
+import time
 import email
+import socket
+import logs
+import oauth2
 import logging
+import metrics
+import threading
 
 from pytz import timezone
-from imaplib import IMAP4_SSL
+from imaplib import IMAP4, IMAP4_SSL
 from datetime import datetime, timedelta
 from Crypto.Cipher import AES
 
@@ -16,12 +23,27 @@ def decrypt(ciphertext):
 ENABLED = True
 DEBUG = False
 
-try:
-    with open("tokens/gmail", 'rb') as gmail_token:
-        GMAIL_TOKEN = decrypt(gmail_token.read().strip()).strip()
+OAUTH_FILE = "tokens/gmail_oauth" # { client_id, client_secret, refresh_token[, accounts_url] }, enables XOAUTH2
+ACCESS_TOKEN_FILE = "tokens/gmail_access" # cached { access_token, expires_at }
+
+OAUTH = None
+ACCESS_TOKEN = None # (token, expiry epoch)
+
+REFRESH_MARGIN_SECONDS = 300 # pre-refresh the access token this long before it expires
+EXPIRY_MARGIN_SECONDS = 30 # refresh on login if the token expires sooner than this
+RETRY_SECONDS = 60
+OAUTH_TIMEOUT_SECONDS = 10
 
+try:
     with open("tokens/gmail_at", 'r') as gmail:
         GMAIL_MAIL = gmail.read().strip()
+
+    if os.path.isfile(OAUTH_FILE):
+        with open(OAUTH_FILE, 'r') as gmail_oauth:
+            OAUTH = json.load(gmail_oauth)
+    else:
+        with open("tokens/gmail", 'rb') as gmail_token:
+            GMAIL_TOKEN = decrypt(gmail_token.read().strip()).strip()
 except FileNotFoundError:
     ENABLED = False
     logging.warn("Alerts from Gmail are disabled")
@@ -29,20 +51,95 @@ except FileNotFoundError:
 TIMEZONE = timezone('Europe/Madrid')
 IMAP_SERVER = "imap.gmail.com"
 IMAP_PORT = 993
+IMAP_SSL = True
 INBOX = "Trading"
 PREFIX = "Alerta: "
 
 DATE_FORMAT = "%d-%b-%Y"
 DATE_TIME_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
 
+# XOAUTH2
+
+__token_lock = threading.Lock()
+__mail_lock = threading.Lock() # one IMAP session at a time, shared by every bot of the process
+__stop = threading.Event()
+
+def __load_access_token():
+    global ACCESS_TOKEN
+    try:
+        with open(ACCESS_TOKEN_FILE, 'r') as access_file:
+            cached = json.load(access_file)
+        ACCESS_TOKEN = (cached['access_token'], cached['expires_at'])
+    except (FileNotFoundError, ValueError, KeyError):
+        ACCESS_TOKEN = None
+
+def refresh_access_token():
+    """ Get a new access token with the refresh token and persist it with its expiry """
+    global ACCESS_TOKEN
+    with metrics.outbound('OAuth', 'token'):
+        response = oauth2.RefreshToken(OAUTH['client_id'], OAUTH['client_secret'], OAUTH['refresh_token'],
+            OAUTH.get('accounts_url'), timeout=OAUTH_TIMEOUT_SECONDS)
+    token = (response['access_token'], time.time() + int(response['expires_in']))
+    tmp = ACCESS_TOKEN_FILE + '.tmp'
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as access_file:
+        json.dump({ 'access_token': token[0], 'expires_at': token[1] }, access_file)
+    os.replace(tmp, ACCESS_TOKEN_FILE)
+    ACCESS_TOKEN = token
+    logs.event('oauth_token_refreshed', expires_in=int(response['expires_in']))
+    return token[0]
+
+def access_token():
+    """ Cached access token, only refreshed here if the background refresher could not do it in time """
+    with __token_lock:
+        if ACCESS_TOKEN is None:
+            __load_access_token()
+        if ACCESS_TOKEN is None or ACCESS_TOKEN[1] - time.time() < EXPIRY_MARGIN_SECONDS:
+            metrics.miss('oauth_token')
+            return refresh_access_token()
+        metrics.hit('oauth_token')
+        return ACCESS_TOKEN[0]
+
+def __refresher():
+    while True:
+        expires_at = ACCESS_TOKEN[1] if ACCESS_TOKEN else 0
+        if __stop.wait(max(expires_at - REFRESH_MARGIN_SECONDS - time.time(), 0)):
+            return
+        try:
+            with __token_lock:
+                refresh_access_token()
+        except Exception:
+            logs.exception('oauth_refresh_failed')
+            if __stop.wait(RETRY_SECONDS):
+                return
+
+def start_refresher():
+    """ Refresh the XOAUTH2 access token in the background before it expires """
+    if ENABLED and OAUTH:
+        with __token_lock:
+            if ACCESS_TOKEN is None:
+                __load_access_token()
+        __stop.clear()
+        threading.Thread(target=__refresher, name='oauth', daemon=True).start()
+
+def stop_refresher():
+    __stop.set()
+
+# IMAP
+
 def login():
     global mail
     if ENABLED:
         logging.info(f"Logging to mail ({INBOX})...")
         try:
-            mail = IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            mail.login(GMAIL_MAIL, GMAIL_TOKEN)
-            mail.select(INBOX)
+            auth = oauth2.GenerateOAuth2String(GMAIL_MAIL, access_token(), base64_encode=False) if OAUTH else None
+            with metrics.outbound('IMAP', 'login'):
+                mail = (IMAP4_SSL if IMAP_SSL else IMAP4)(IMAP_SERVER, IMAP_PORT)
+                mail.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # imaplib writes the SASL response and CRLF separately
+                if auth:
+                    mail.authenticate('XOAUTH2', lambda _: auth)
+                else:
+                    mail.login(GMAIL_MAIL, GMAIL_TOKEN)
+                mail.select(INBOX)
         except Exception as e:
             logging.warn("Cannot login")
             logout()
@@ -56,30 +153,34 @@ def logout():
         mail = None
 
 def __read_alert(mail_id):
-    global mail
-    _, data = mail.uid('fetch', mail_id, 'BODY.PEEK[HEADER.FIELDS (SUBJECT DATE)]')
+    with metrics.outbound('IMAP', 'fetch'):
+        _, data = mail.uid('fetch', mail_id, 'BODY.PEEK[HEADER.FIELDS (SUBJECT DATE)]')
     msg = email.message_from_string(data[0][1].decode('utf-8'))
     subject = msg['subject'].replace(PREFIX, '', 1).replace('\r\n', '')
     date = datetime.strptime(msg['date'], DATE_TIME_FORMAT)
     return subject, date
 
-def get_last_alert_date():
-    if os.path.isfile('lastAlert'):
-        with open('lastAlert', 'r') as lastAlertFile:
+LAST_ALERT_FILE = 'lastAlert'
+
+def get_last_alert_date(file=LAST_ALERT_FILE):
+    if os.path.isfile(file):
+        with open(file, 'r') as lastAlertFile:
             lastAlert = lastAlertFile.read()
             lastAlertDate = datetime.strptime(lastAlert.split(' -> ', 1)[0], DATE_TIME_FORMAT).astimezone(TIMEZONE)
             return lastAlertDate
     return None
 
-def update_alerts(maxHours=24):
-    global mail
-
+def update_alerts(maxHours=24, file=LAST_ALERT_FILE):
+    """ New alerts since the last one recorded in file """
     if not ENABLED:
         return None
+    with __mail_lock:
+        return __update_alerts(maxHours, file)
 
-    print(f"{datetime.now(TIMEZONE).strftime(DATE_TIME_FORMAT)} - Update last alert")
+def __update_alerts(maxHours, file):
+    logs.event('alerts_update')
 
-    lastAlertDate = get_last_alert_date()
+    lastAlertDate = get_last_alert_date(file)
 
     if not lastAlertDate:
         lastAlertDate = datetime.now(TIMEZONE) - timedelta(hours=maxHours)
@@ -87,7 +188,8 @@ def update_alerts(maxHours=24):
     login()
 
     since = lastAlertDate.strftime(DATE_FORMAT)
-    _, data = mail.search(None, r'(SENTSINCE {date}) (FROM "noreply@tradingview.com") (X-GM-RAW "subject:\"{prefix}\"")'.format(date=since, prefix=PREFIX))
+    with metrics.outbound('IMAP', 'search'):
+        _, data = mail.search(None, r'(SENTSINCE {date}) (FROM "noreply@tradingview.com") (X-GM-RAW "subject:\"{prefix}\"")'.format(date=since, prefix=PREFIX))
     mail_ids = data[0].split()
 
     alerts = []
@@ -99,15 +201,17 @@ def update_alerts(maxHours=24):
             alertText = f"{alertParts[0].upper()} {' '.join(alertParts[1:])}"
             alerts.append((alertDate, alertText))
             newAlert = f'{alertDate.astimezone(TIMEZONE).strftime(DATE_TIME_FORMAT)} -> {alertText}'
-            print(newAlert)
+            logs.event('alert_received', date=alertDate.isoformat(), text=alertText)
     
     logout()
     
     if alerts:
-        with open('lastAlert', 'w') as lastAlertFile:
+        with open(file, 'w') as lastAlertFile:
             lastAlertFile.write(newAlert)
     
     return alerts
 
 if __name__ == '__main__':
+    logs.setup(file=None)
     update_alerts()
+    logs.stop()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline load generator for the Telegram command pipeline.
+
+Synthetic updates for the registered commands arrive at a fixed mean rate (Poisson arrivals) and go through the real
+dispatcher and handlers of bot.py. Telegram is replaced by a stub Bot and the exchanges and IMAP by the benchmark
+stubs, so no tokens or network access are needed. Latency is measured from arrival to the first reply in the chat.
+
+    python3 loadtest.py --users 5000 --rate 200 --duration 30
+    python3 loadtest.py --mix price=50,account=30,trade=20 --telegram-latency 50 --output load.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import tempfile
+import argparse
+import itertools
+import threading
+
+from datetime import datetime
+
+import telegram
+
+from telegram import Update
+from telegram.utils.request import Request
+
+import bot
+import logs
+import trading
+import benchmark
+from account import Account
+
+MIX = { 'price': 30, 'trade': 15, 'tradeAll': 5, 'account': 20, 'history': 10, 'list': 15, 'subscribe': 5 }
+
+TOKEN = '123456:LOADTESTloadtestLOADTESTloadtest123' # well-formed, never sent anywhere
+
+# STUBS
+
+class StubBot(telegram.Bot):
+    """ Telegram Bot answering every API call locally, recording the first message sent to each chat """
+
+    def __init__(self, latency=0):
+        super().__init__(TOKEN, request=Request(con_pool_size=8))
+        self.latency = latency
+        self.sent = dict() # chat id to perf_counter time of the first message
+        self.message_ids = itertools.count(1)
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        time.sleep(self.latency)
+        if endpoint in ('sendMessage', 'editMessageText'):
+            self.sent.setdefault(data['chat_id'], time.perf_counter())
+            return {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': { 'id': data['chat_id'], 'type': 'private' },
+                'text': data.get('text', '')
+            }
+        if endpoint == 'getMe':
+            return { 'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot' }
+        return True
+
+def update(update_id, username, text):
+    """ Synthetic Telegram update for a command message, in a chat of its own """
+    command = text.split(' ', 1)[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': { 'id': update_id, 'type': 'private' },
+            'from': { 'id': hash(username) & 0xffffffff, 'is_bot': False, 'first_name': username, 'username': username },
+            'text': text,
+            'entities': [{ 'type': 'bot_command', 'offset': 0, 'length': len(command) }]
+        }
+    }
+
+def command(name, coins, rng):
+    """ Text of a random command of this kind """
+    coin = rng.choice(coins)
+    if name == 'price':
+        return f"/price {coin}{benchmark.CURRENCY}"
+    if name == 'trade':
+        return f"/trade {rng.choice(['BUY', 'SELL'])} {rng.choice(['0.01', '0.1', '1'])} {coin}"
+    if name == 'tradeAll':
+        return f"/tradeAll {rng.choice(['BUY', 'SELL'])} {coin}"
+    return f"/{name}"
+
+# LOAD
+
+def setup(users, superusers, balance, bot_latency):
+    """ Real dispatcher and handlers of bot.py on a stub Bot, with an in-memory account per user """
+    stub = StubBot(bot_latency)
+    tenant = bot.Tenant(stub, users[:superusers])
+    tenant.name = 'LoadTest'
+    bot.TENANTS.append(tenant)
+    bot.add_handlers(tenant)
+    errors = list()
+    tenant.dispatcher.add_error_handler(lambda update, context: errors.append((update, context.error)))
+    for user in users:
+        trading.ACCOUNTS[user] = Account(user, balance, benchmark.CURRENCY)
+    tenant.updater.job_queue.start()
+    threading.Thread(target=tenant.dispatcher.start, name='dispatcher', daemon=True).start()
+    return stub, errors
+
+def run(stub, users, mix, coins, rate, duration, seed):
+    """ Feed updates at rate per second for duration seconds, returns the sent requests (chat id, command, arrival time) """
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    requests = []
+    start = time.perf_counter()
+    arrival = start
+    for update_id in itertools.count(1):
+        arrival += rng.expovariate(rate)
+        if arrival - start >= duration:
+            break
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        name = rng.choices(names, weights)[0]
+        text = command(name, coins, rng)
+        requests.append((update_id, name, time.perf_counter()))
+        bot.TENANTS[0].dispatcher.update_queue.put(Update.de_json(update(update_id, rng.choice(users), text), stub))
+    return requests
+
+def drain(stub, requests, timeout):
+    """ Wait until every request got a reply or timeout seconds passed without progress """
+    deadline = time.perf_counter() + timeout
+    answered = 0
+    while time.perf_counter() < deadline:
+        current = sum(1 for update_id, _, _ in requests if update_id in stub.sent)
+        if current == len(requests):
+            return
+        if current > answered:
+            answered, deadline = current, time.perf_counter() + timeout
+        time.sleep(0.05)
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else None
+
+def summarize(name, requests, stub, errors, elapsed):
+    latencies = sorted((stub.sent[update_id] - arrival) * 1000 for update_id, _, arrival in requests if update_id in stub.sent)
+    unanswered = len(requests) - len(latencies)
+    return {
+        'name': name,
+        'requests': len(requests),
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1] if latencies else None,
+        'errors': errors,
+        'unanswered': unanswered,
+        'error_rate': (errors + unanswered) / len(requests) if requests else 0
+    }
+
+def report(requests, stub, errors, elapsed):
+    failed = dict() # update id to handler errors
+    for update, _ in errors:
+        if isinstance(update, Update):
+            failed[update.update_id] = failed.get(update.update_id, 0) + 1
+    results = [summarize('total', requests, stub, len(failed), elapsed)]
+    for name in sorted(set(name for _, name, _ in requests)):
+        selected = [request for request in requests if request[1] == name]
+        results.append(summarize(name, selected, stub, sum(1 for update_id, _, _ in selected if update_id in failed), elapsed))
+    return results
+
+def mix(s):
+    weights = dict()
+    for part in s.split(','):
+        name, weight = part.split('=')
+        if name not in MIX:
+            raise argparse.ArgumentTypeError(f"unknown command {name}, expected one of {', '.join(MIX)}")
+        weights[name] = float(weight)
+    return weights
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of the Telegram command pipeline")
+    parser.add_argument('--users', type=int, default=5000, help="distinct users sending commands")
+    parser.add_argument('--superusers', type=int, default=0, help="users allowed to /subscribe")
+    parser.add_argument('--rate', type=float, default=100, help="mean arrival rate (updates per second)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of arrivals")
+    parser.add_argument('--mix', type=mix, default=MIX, help=f"command weights, default {','.join(f'{k}={v}' for k, v in MIX.items())}")
+    parser.add_argument('--pairs', type=int, default=100, help="symbols served by the stub exchange")
+    parser.add_argument('--latency', type=float, default=0, help="stub exchange and IMAP latency per request (ms)")
+    parser.add_argument('--telegram-latency', type=float, default=0, help="stub Telegram latency per API call (ms)")
+    parser.add_argument('--drain', type=float, default=10, help="seconds to wait for replies without progress before giving up")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.TemporaryDirectory(prefix='kitraderbot-loadtest-')
+    os.chdir(workdir.name)
+    os.mkdir('accounts')
+    logs.setup(file='loadtest.jsonl', stdout=False)
+    benchmark.start_stubs(args.latency / 1000, args.pairs)
+    coins = benchmark.symbols(args.pairs)
+
+    users = [f"user{i}" for i in range(args.users)]
+    stub, errors = setup(users, args.superusers, 1000.0, args.telegram_latency / 1000)
+
+    start = time.perf_counter()
+    requests = run(stub, users, args.mix, coins, args.rate, args.duration, args.seed)
+    drain(stub, requests, args.drain)
+    elapsed = time.perf_counter() - start
+
+    bot.TENANTS[0].updater.job_queue.stop()
+    bot.TENANTS[0].dispatcher.stop()
+    logs.stop()
+
+    result = {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': args.users,
+            'rate': args.rate,
+            'duration': args.duration,
+            'mix': args.mix,
+            'latency_ms': args.latency,
+            'telegram_latency_ms': args.telegram_latency,
+            'elapsed': elapsed
+        },
+        'results': report(requests, stub, errors, elapsed)
+    }
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Structured logging: JSON lines written by a background thread.
+
+Handlers only enqueue records (dropping them if the queue is full), so no command waits on log I/O.
+"""
+
+import os
+import json
+import random
+import logging
+import metrics
+
+from queue import Queue, Full
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+FILE = 'logs/kitrader.jsonl'
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+
+STDOUT = True
+
+QUEUE_SIZE = 10000
+
+SAMPLE_RATES = { 'command': 1.0, 'message': 1.0 } # event to fraction of records kept, warnings are always kept
+
+LOGGER = logging.getLogger('kitrader')
+LOGGER.setLevel(logging.INFO)
+LOGGER.propagate = False
+
+listener = None
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'event': getattr(record, 'event', record.getMessage())
+        }
+        line.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+class Sampler(logging.Filter):
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = SAMPLE_RATES.get(getattr(record, 'event', None), 1.0)
+        return rate >= 1 or random.random() < rate
+
+class DroppingQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = JsonFormatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            metrics.inc('log_dropped_total')
+
+def setup(file=FILE, stdout=STDOUT):
+    """ Start the background writer, call once at startup """
+    global listener
+    if listener is not None:
+        return
+    handlers = []
+    if file:
+        os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+        handlers.append(RotatingFileHandler(file, maxBytes=MAX_BYTES, backupCount=BACKUPS, encoding='utf-8'))
+    if stdout:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(JsonFormatter())
+    queue = Queue(QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(queue)
+    queue_handler.addFilter(Sampler())
+    LOGGER.addHandler(queue_handler)
+    metrics.gauge('queue_depth', queue.qsize, queue='logs')
+    listener = QueueListener(queue, *handlers, respect_handler_level=False)
+    listener.start()
+
+def stop():
+    """ Flush pending records and stop the background writer """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def event(name, level=logging.INFO, **fields):
+    LOGGER.log(level, name, extra={ 'event': name, 'fields': fields })
+
+def exception(name, **fields):
+    LOGGER.error(name, exc_info=True, extra={ 'event': name, 'fields': fields })
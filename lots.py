@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lot ledgers: cost basis of the positions of an account.
+
+A ledger holds the open lots of a position, oldest first, as [amount in units of the symbol, cost in units of the
+account currency with fees], and their running totals. A BUY opens a lot and a SELL closes lots by the cost method of
+the account: FIFO takes the oldest lots first, LIFO the newest, and AVERAGE keeps a single lot at the average cost.
+Every lot is opened and closed once, so a trade costs O(1) amortized whatever the number of lots.
+"""
+
+from collections import deque
+
+FIFO = 'FIFO'
+LIFO = 'LIFO'
+AVERAGE = 'AVERAGE'
+
+METHODS = (FIFO, LIFO, AVERAGE)
+
+class Ledger:
+
+    __slots__ = ('lots', 'amount', 'cost')
+
+    def __init__(self, lots=()):
+        """ lots: iterable of (amount, cost), oldest first """
+        self.lots = deque()
+        self.amount = 0 # units of the symbol, the amount of the position
+        self.cost = 0 # cost basis in units of the account currency
+        for amount, cost in lots:
+            self.open(amount, cost)
+
+    def __len__(self):
+        return len(self.lots)
+
+    def open(self, amount, cost, method=FIFO):
+        if method == AVERAGE and self.lots:
+            self.lots[0][0] += amount
+            self.lots[0][1] += cost
+        else:
+            self.lots.append([amount, cost])
+        self.amount += amount
+        self.cost += cost
+
+    def close(self, amount, method=FIFO):
+        """ Close an amount of the lots by method, returns its cost basis """
+        if amount >= self.amount:
+            basis = self.cost
+            self.lots.clear()
+            self.amount = self.cost = 0
+            return basis
+        end, pop = (-1, self.lots.pop) if method == LIFO else (0, self.lots.popleft)
+        basis, remaining = 0, amount
+        while remaining:
+            lot = self.lots[end]
+            if lot[0] <= remaining:
+                pop()
+                remaining -= lot[0]
+                basis += lot[1]
+            else: # partial close, the lot keeps the rest of its cost
+                part = lot[1] * remaining // lot[0]
+                lot[0] -= remaining
+                lot[1] -= part
+                basis += part
+                remaining = 0
+        self.amount -= amount
+        self.cost -= basis
+        return basis
+
+    def average(self):
+        """ Merge the lots into one at the average cost, e.g. when switching to AVERAGE """
+        if len(self.lots) > 1:
+            self.lots = deque([[self.amount, self.cost]])
+
+    def copy(self):
+        return Ledger(self.lots)
+
+    def toJSON(self):
+        return [list(lot) for lot in self.lots]
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory budget report for the /memory command.
+
+Allocations are attributed to subsystems with tracemalloc, by the innermost frame of the bot's own modules
+(or by the top-level package for library allocations). Resident accounts are ranked by their deep size.
+"""
+
+import os
+import sys
+import resource
+import tracemalloc
+
+from itertools import islice
+
+FRAMES = 10 # traceback depth kept by tracemalloc, enough to find a bot frame under json, pickle or telegram
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SUBSYSTEMS = { # bot module to subsystem
+    'account.py': 'accounts', 'trading.py': 'accounts', 'money.py': 'accounts', 'snapshot.py': 'accounts',
+    'valuation.py': 'valuation', 'conversion.py': 'valuation', 'execution.py': 'accounts', 'exposure.py': 'accounts', 'lots.py': 'accounts', 'export.py': 'accounts',
+    'api.py': 'market data', 'bitstamp.py': 'market data', 'binance.py': 'market data', 'circuit.py': 'market data',
+    'render.py': 'responses',
+    'bot.py': 'telegram', 'webhook.py': 'telegram',
+    'gmail.py': 'alerts', 'oauth2.py': 'alerts',
+    'logs.py': 'logs', 'metrics.py': 'metrics', 'shards.py': 'shards'
+}
+
+def start():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(FRAMES)
+
+def __subsystem(traceback):
+    for frame in traceback: # most recent call first
+        if os.path.dirname(frame.filename) == ROOT:
+            return SUBSYSTEMS.get(os.path.basename(frame.filename), 'other')
+    path = traceback[0].filename
+    for directory in sorted(filter(None, sys.path), key=len, reverse=True):
+        if path.startswith(directory + os.sep):
+            return path[len(directory) + 1:].split(os.sep, 1)[0].replace('.py', '')
+    return 'other'
+
+def subsystems():
+    """ Traced bytes by subsystem, largest first """
+    sizes = dict()
+    for stat in tracemalloc.take_snapshot().statistics('traceback'):
+        subsystem = __subsystem(stat.traceback)
+        sizes[subsystem] = sizes.get(subsystem, 0) + stat.size
+    return sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+
+def footprint(account):
+    """ Deep size of an account in bytes, excluding interned symbols and shared strings """
+    size = sys.getsizeof(account) + sys.getsizeof(account.user) + sys.getsizeof(account.balance) + sys.getsizeof(account.initial_balance)
+    size += sys.getsizeof(account.historic) + sum(map(sys.getsizeof, account.historic))
+    positions = account.positions
+    size += sys.getsizeof(positions) + sys.getsizeof(positions.symbols) + sys.getsizeof(positions.amounts)
+    size += sys.getsizeof(account.ledgers) + sum(sys.getsizeof(ledger) + sys.getsizeof(ledger.lots) + sum(map(sys.getsizeof, ledger.lots)) for ledger in account.ledgers.values())
+    if account._values:
+        size += sys.getsizeof(account._values) + sum(sys.getsizeof(value) + sys.getsizeof(value[1]) for value in account._values.values())
+    return size
+
+def __size(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def report(accounts, top=10):
+    """ Memory report of this process: subsystems (if tracing) and the largest resident accounts """
+    text = f"Max RSS: {__size(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)}"
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        text += f"\nTraced: {__size(current)} (peak {__size(peak)})\n\nBy subsystem:"
+        for subsystem, size in islice(subsystems(), top):
+            text += f"\n{subsystem}: {__size(size)}"
+    else:
+        start()
+        text += "\n\nTracing allocations from now on, send /memory again for the subsystems."
+    sizes = sorted(((footprint(account), account) for account in list(accounts.values())), key=lambda item: item[0], reverse=True)
+    total = sum(size for size, _ in sizes)
+    text += f"\n\nResident accounts: {len(sizes)}, {__size(total)}"
+    if sizes:
+        text += f" ({__size(total / len(sizes))} per account)\n\nTop accounts:"
+        for size, account in sizes[:top]:
+            text += f"\n{account.user}: {__size(size)} ({len(account.positions)} positions, {len(account.historic)} trades)"
+    return text
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Hot-path metrics: latency histograms, counters and gauges.
+
+Exposed in Prometheus text format on http://HOST:PORT/metrics and summarized by the /metrics command.
+"""
+
+import time
+import threading
+
+from functools import wraps
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOST = '127.0.0.1'
+PORT = 9464
+
+PREFIX = 'kitrader_'
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+HELP = {
+    'command_seconds': "Telegram command handler latency",
+    'outbound_seconds': "Outbound exchange, IMAP and Telegram call latency",
+    'outbound_errors_total': "Outbound calls that failed or returned an error status",
+    'cache_requests_total': "Cache lookups by result (hit or miss)",
+    'queue_depth': "Pending items in internal queues",
+    'log_dropped_total': "Log records dropped because the log queue was full",
+    'circuit_open': "1 while the exchange circuit breaker is open or half-open",
+    'circuit_rejected_total': "Outbound calls rejected without a request because the exchange circuit is open",
+    'stale_quotes_total': "Last known prices served while an exchange circuit is open",
+    'webhook_updates_total': "Webhook requests by result (accepted, backpressure, forbidden, invalid, not_found)"
+}
+
+__lock = threading.Lock()
+
+HISTOGRAMS = dict() # (name, labels) to Histogram
+COUNTERS = dict() # (name, labels) to value
+GAUGES = dict() # (name, labels) to function returning the current value
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """ Upper bound of the bucket containing the q quantile """
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+def __key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    with __lock:
+        key = (name, __key(labels))
+        if key not in HISTOGRAMS:
+            HISTOGRAMS[key] = Histogram()
+        HISTOGRAMS[key].observe(seconds)
+
+def inc(name, value=1, **labels):
+    with __lock:
+        key = (name, __key(labels))
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+def gauge(name, f, **labels):
+    """ Register a gauge, f() is called on every scrape """
+    GAUGES[(name, __key(labels))] = f
+
+def hit(cache):
+    inc('cache_requests_total', cache=cache, result='hit')
+
+def miss(cache):
+    inc('cache_requests_total', cache=cache, result='miss')
+
+def error(service, endpoint):
+    inc('outbound_errors_total', service=service, endpoint=endpoint)
+
+@contextmanager
+def timer(name, **labels):
+    """ Observe the duration of the block, outbound calls raising an exception also count as errors """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if name == 'outbound_seconds':
+            error(labels.get('service'), labels.get('endpoint'))
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name, **labels):
+    """ Decorator version of timer """
+    def decorator(f):
+        @wraps(f)
+        def timed_f(*args, **kwargs):
+            with timer(name, **labels):
+                return f(*args, **kwargs)
+        return timed_f
+    return decorator
+
+def command(name):
+    """ Decorator for Telegram handlers """
+    return timed('command_seconds', command=name)
+
+def outbound(service, endpoint):
+    return timer('outbound_seconds', service=service, endpoint=endpoint)
+
+# EXPOSITION
+
+def __labels(labels, **extra):
+    labels = labels + tuple(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}'
+
+def __bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+def __header(lines, name, kind):
+    lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+def exposition():
+    """ All metrics in Prometheus text format """
+    with __lock:
+        histograms = { key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in HISTOGRAMS.items() }
+        counters = dict(COUNTERS)
+    lines = []
+    last = None
+    for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+        if name != last:
+            __header(lines, name, 'histogram')
+            last = name
+        cumulative = 0
+        for bound, bucket in zip(buckets + (float('inf'),), counts):
+            cumulative += bucket
+            lines.append(f"{PREFIX}{name}_bucket{__labels(labels, le=__bound(bound))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_sum{__labels(labels)} {total}")
+        lines.append(f"{PREFIX}{name}_count{__labels(labels)} {count}")
+    for (name, labels), value in sorted(counters.items()):
+        if name != last:
+            __header(lines, name, 'counter')
+            last = name
+        lines.append(f"{PREFIX}{name}{__labels(labels)} {value}")
+    for (name, labels), f in sorted(GAUGES.items(), key=lambda item: item[0]):
+        if name != last:
+            __header(lines, name, 'gauge')
+            last = name
+        try:
+            lines.append(f"{PREFIX}{name}{__labels(labels)} {f()}")
+        except Exception:
+            pass
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    """ Human readable summary for the /metrics command """
+    with __lock:
+        histograms = sorted(HISTOGRAMS.items())
+        counters = dict(COUNTERS)
+    def ms(seconds):
+        return f"{round(seconds * 1000)}ms" if seconds != float('inf') else f">{round(BUCKETS[-1] * 1000)}ms"
+    text = "Commands:"
+    outbound = "\n\nOutbound calls:"
+    for (name, labels), h in histograms:
+        labels = dict(labels)
+        stats = f"{h.count} calls, mean {ms(h.mean())}, p50 ≤ {ms(h.quantile(0.5))}, p99 ≤ {ms(h.quantile(0.99))}"
+        if name == 'command_seconds':
+            text += f"\n/{labels['command']}: {stats}"
+        elif name == 'outbound_seconds':
+            errors = counters.get(('outbound_errors_total', __key(labels)), 0)
+            outbound += f"\n{labels['service']} {labels['endpoint']}: {stats}, {errors} errors"
+    text += outbound
+    caches = dict()
+    for (name, labels), value in counters.items():
+        if name == 'cache_requests_total':
+            labels = dict(labels)
+            caches.setdefault(labels['cache'], dict())[labels['result']] = value
+    if caches:
+        text += "\n\nCaches:"
+        for cache, results in sorted(caches.items()):
+            hits, misses = results.get('hit', 0), results.get('miss', 0)
+            text += f"\n{cache}: {round(100 * hits / (hits + misses), 1)}% hits ({hits + misses} lookups)"
+    queues = [(dict(labels).get('queue'), f) for (name, labels), f in GAUGES.items() if name == 'queue_depth']
+    if queues:
+        text += "\n\nQueues:"
+        for queue, f in sorted(queues, key=lambda q: q[0]):
+            try:
+                text += f"\n{queue}: {f()}"
+            except Exception:
+                text += f"\n{queue}: unavailable"
+    return text
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host=HOST, port=PORT):
+    """ Serve /metrics in a background thread """
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
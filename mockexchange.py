@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local mock of the Bitstamp and Binance endpoints used by the bot, to develop and benchmark without the real exchanges.
+
+Prices follow a random walk, or replay a CSV file one row per tick (a column per pair, e.g. time,BTC/USD,ETH/USD; other
+columns are ignored). Every tick trades each pair once: trades build the OHLC candles and are streamed over WebSocket,
+Binance style at ws://host:port/ws/btcusd@trade (streams joined by /) and Bitstamp style at ws://host:port/ws with
+bts:subscribe to live_trades_btcusd channels. Latency, injected server errors and rate limits (429) are configurable:
+
+    python3 mockexchange.py --port 8090 --csv prices.csv --latency 50 --errors 0.01 --rate-limit 600
+
+and point the bot to it in config.json:
+
+    { "base_urls": { "Bitstamp": "http://127.0.0.1:8090/api/v2", "Binance": "http://127.0.0.1:8090" } }
+"""
+
+import csv
+import sys
+import json
+import math
+import time
+import base64
+import queue
+import random
+import hashlib
+import argparse
+import itertools
+import threading
+
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PORT = 8090
+
+TICK_SECONDS = 1
+
+VOLATILITY = 0.001 # standard deviation of the random walk per tick
+
+PRICES = { 'BTC/USD': 30000.0, 'ETH/USD': 2000.0, 'XRP/USD': 0.5, 'LTC/USD': 80.0, 'EUR/USD': 1.08 }
+
+BOOK_LEVELS = 50
+BOOK_LEVEL_AMOUNT = 1000
+
+MAX_CANDLES = 1440 # one minute candles kept per pair
+
+INTERVALS = { '1m': 60, '3m': 180, '5m': 300, '15m': 900, '30m': 1800, '1h': 3600, '2h': 7200, '4h': 14400, '6h': 21600, '8h': 28800, '12h': 43200, '1d': 86400 }
+
+SUBSCRIPTION_EVENTS = { 'bts:subscribe': 'bts:subscription_succeeded', 'bts:unsubscribe': 'bts:unsubscription_succeeded' }
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def number(value):
+    return f"{value:.10g}"
+
+# MARKET
+
+class Market:
+    """ Prices of the mock pairs, moved one step every tick by a random walk or a CSV replay """
+
+    def __init__(self, prices=PRICES, replay=None, volatility=VOLATILITY, seed=None):
+        self.pairs = { base + quote: (base, quote) for base, quote in (pair.split('/') for pair in prices) } # SYMBOL to (base, quote)
+        self.prices = { base + quote: price for (base, quote), price in zip(self.pairs.values(), prices.values()) }
+        self.replay = replay # rows of pair to price, cycled
+        self.volatility = volatility
+        self.random = random.Random(seed)
+        self.steps = 0
+        self.trade_ids = itertools.count(1)
+        self.candles = { symbol: deque(maxlen=MAX_CANDLES) for symbol in self.prices } # [minute, open, high, low, close, volume]
+        self.listeners = set() # queues receiving (symbol, trade)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(file):
+        """ Rows of a price CSV file, pair to price """
+        with open(file, newline='') as csv_file:
+            return [{ pair: float(price) for pair, price in row.items() if '/' in pair and price } for row in csv.DictReader(csv_file)]
+
+    def pair(self, symbol):
+        base, quote = self.pairs[symbol]
+        return f"{base}/{quote}"
+
+    def step(self):
+        """ Move every price and trade each pair once """
+        now = time.time()
+        with self.lock:
+            if self.replay:
+                row = self.replay[self.steps % len(self.replay)]
+                for pair, price in row.items():
+                    symbol = pair.replace('/', '')
+                    if symbol in self.prices:
+                        self.prices[symbol] = price
+            elif self.volatility:
+                for symbol, price in self.prices.items():
+                    self.prices[symbol] = float(number(price * math.exp(self.random.gauss(0, self.volatility))))
+            self.steps += 1
+            trades = []
+            for symbol, price in self.prices.items():
+                trade = { 'id': next(self.trade_ids), 'price': price, 'amount': round(self.random.expovariate(1), 8), 'timestamp': now, 'sell': self.random.random() < 0.5 }
+                self.__candle(symbol, trade)
+                trades.append((symbol, trade))
+            listeners = tuple(self.listeners)
+        for listener in listeners:
+            for trade in trades:
+                listener.put(trade)
+
+    def __candle(self, symbol, trade):
+        minute = int(trade['timestamp']) // 60 * 60
+        candles = self.candles[symbol]
+        if candles and candles[-1][0] == minute:
+            candle = candles[-1]
+            candle[2], candle[3] = max(candle[2], trade['price']), min(candle[3], trade['price'])
+            candle[4] = trade['price']
+            candle[5] += trade['amount']
+        else:
+            candles.append([minute, trade['price'], trade['price'], trade['price'], trade['price'], trade['amount']])
+
+    def ohlc(self, symbol, step, limit):
+        """ Last limit candles of step seconds (a multiple of a minute) """
+        with self.lock:
+            candles = list(self.candles[symbol])
+        merged = []
+        for minute, open, high, low, close, volume in candles:
+            start = minute // step * step
+            if merged and merged[-1][0] == start:
+                candle = merged[-1]
+                candle[2], candle[3], candle[4] = max(candle[2], high), min(candle[3], low), close
+                candle[5] += volume
+            else:
+                merged.append([start, open, high, low, close, volume])
+        return merged[-limit:]
+
+    def book(self, symbol):
+        """ Order book around the price, BOOK_LEVELS levels of BOOK_LEVEL_AMOUNT per side 0.05% apart """
+        price = self.prices[symbol]
+        return {
+            'timestamp': str(int(time.time())),
+            'bids': [[number(price * (1 - 0.0005 * (i + 1))), str(BOOK_LEVEL_AMOUNT)] for i in range(BOOK_LEVELS)],
+            'asks': [[number(price * (1 + 0.0005 * (i + 1))), str(BOOK_LEVEL_AMOUNT)] for i in range(BOOK_LEVELS)]
+        }
+
+    def run(self, tick=TICK_SECONDS):
+        while True:
+            time.sleep(tick)
+            self.step()
+
+# WEBSOCKET
+
+def frame(payload, opcode=0x1):
+    """ Unmasked final frame, as sent by a server """
+    size = len(payload)
+    if size < 126:
+        header = bytes([0x80 | opcode, size])
+    elif size < 1 << 16:
+        header = bytes([0x80 | opcode, 126]) + size.to_bytes(2, 'big')
+    else:
+        header = bytes([0x80 | opcode, 127]) + size.to_bytes(8, 'big')
+    return header + payload
+
+def read_frame(stream):
+    """ (opcode, payload) of the next client frame, (None, None) when the connection is closed """
+    head = stream.read(2)
+    if len(head) < 2:
+        return None, None
+    size = head[1] & 0x7f
+    if size >= 126:
+        size = int.from_bytes(stream.read(2 if size == 126 else 8), 'big')
+    mask = stream.read(4) if head[1] & 0x80 else bytes(4)
+    payload = stream.read(size)
+    return head[0] & 0x0f, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+def binance_trade(symbol, trade):
+    milliseconds = int(trade['timestamp'] * 1000)
+    return { 'e': 'trade', 'E': milliseconds, 's': symbol, 't': trade['id'], 'p': number(trade['price']), 'q': number(trade['amount']), 'T': milliseconds, 'm': trade['sell'], 'M': True }
+
+def bitstamp_trade(symbol, trade):
+    return { 'event': 'trade', 'channel': f"live_trades_{symbol.lower()}", 'data': {
+        'id': trade['id'], 'timestamp': str(int(trade['timestamp'])), 'microtimestamp': str(int(trade['timestamp'] * 1e6)),
+        'amount': trade['amount'], 'amount_str': number(trade['amount']), 'price': trade['price'], 'price_str': number(trade['price']),
+        'type': int(trade['sell'])
+    }}
+
+# SERVER
+
+class MockExchange(BaseHTTPRequestHandler):
+    """
+    Bitstamp (/api/v2), Binance (/api/v3) and trade stream (/ws) endpoints used by the bot, and the OAuth token
+    endpoint of gmail.py for benchmarks
+    """
+
+    market = Market(volatility=0)
+    latency = 0 # seconds per request
+    jitter = 0 # random extra latency, up to seconds
+    error_rate = 0 # fraction of requests answered with a server error
+    rate_limit = 0 # requests per minute and exchange before 429 responses, 0 for none
+    tokens = itertools.count()
+    requests = dict() # exchange to times of the requests of the last minute
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.delay()
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlparse(self.path).path == '/o/oauth2/token':
+            self.reply(200, { 'access_token': f"mock-{next(self.tokens)}", 'expires_in': 3600, 'token_type': 'Bearer' })
+        else:
+            self.reply(404, {})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path, query = url.path, parse_qs(url.query)
+        if path == '/ws' or path.startswith('/ws/'):
+            return self.websocket(path)
+        self.delay()
+        if path.startswith('/api/v2/'):
+            self.bitstamp(path[len('/api/v2'):], query)
+        elif path.startswith('/api/v3/'):
+            self.binance(path[len('/api/v3'):], query)
+        else:
+            self.reply(404, {})
+
+    def delay(self):
+        seconds = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if seconds:
+            time.sleep(seconds)
+
+    def limited(self, exchange):
+        """ True if the request exceeds the rate limit of exchange or fails by injection, after replying """
+        if self.rate_limit:
+            now = time.monotonic()
+            with self.lock:
+                recent = self.requests.setdefault(exchange, deque())
+                while recent and now - recent[0] >= 60:
+                    recent.popleft()
+                limited = len(recent) >= self.rate_limit
+                if not limited:
+                    recent.append(now)
+            if limited:
+                retry = str(max(1, math.ceil(60 - (now - recent[0]))))
+                if exchange == 'Binance':
+                    self.reply(429, { 'code': -1003, 'msg': "Too many requests." }, { 'Retry-After': retry })
+                else:
+                    self.reply(429, { 'status': 'error', 'reason': "Rate limit exceeded" }, { 'Retry-After': retry })
+                return True
+        if self.error_rate and random.random() < self.error_rate:
+            if exchange == 'Binance':
+                self.reply(500, { 'code': -1000, 'msg': "An unknown error occurred while processing the request." })
+            else:
+                self.reply(500, { 'status': 'error', 'reason': "Internal server error" })
+            return True
+        return False
+
+    def bitstamp(self, path, query):
+        if self.limited('Bitstamp'):
+            return
+        market = self.market
+        parts = path.strip('/').split('/')
+        name, symbol = parts[0], parts[1].upper() if len(parts) > 1 and parts[1] else None
+        if name == 'trading-pairs-info':
+            self.reply(200, [{ 'name': market.pair(symbol), 'url_symbol': symbol.lower(), 'trading': 'Enabled' } for symbol in market.prices])
+        elif name == 'ticker' and symbol is None:
+            self.reply(200, [self.ticker(symbol) for symbol in market.prices])
+        elif name not in ('ticker', 'order_book', 'ohlc'):
+            self.reply(404, {})
+        elif symbol not in market.prices:
+            self.reply(404, { 'status': 'error', 'reason': 'Not Found' })
+        elif name == 'ticker':
+            self.reply(200, self.ticker(symbol))
+        elif name == 'order_book':
+            self.reply(200, market.book(symbol))
+        else:
+            step, limit = int(query.get('step', ['60'])[0]), int(query.get('limit', ['100'])[0])
+            candles = market.ohlc(symbol, max(60, step), max(1, min(limit, 1000)))
+            self.reply(200, { 'data': { 'pair': market.pair(symbol), 'ohlc': [
+                { 'timestamp': str(start), 'open': number(open), 'high': number(high), 'low': number(low), 'close': number(close), 'volume': number(volume) }
+                for start, open, high, low, close, volume in candles
+            ]}})
+
+    def ticker(self, symbol):
+        price = self.market.prices[symbol]
+        return { 'pair': self.market.pair(symbol), 'last': number(price), 'bid': number(price * 0.9995), 'ask': number(price * 1.0005), 'timestamp': str(int(time.time())) }
+
+    def binance(self, path, query):
+        if self.limited('Binance'):
+            return
+        market = self.market
+        symbol = query.get('symbol', [None])[0]
+        if path == '/ping':
+            self.reply(200, {})
+        elif path == '/exchangeInfo':
+            self.reply(200, { 'timezone': 'UTC', 'serverTime': int(time.time() * 1000), 'symbols': [
+                { 'symbol': symbol, 'status': 'TRADING', 'baseAsset': base, 'quoteAsset': quote } for symbol, (base, quote) in market.pairs.items()
+            ]})
+        elif path == '/ticker/price' and symbol is None:
+            self.reply(200, [{ 'symbol': symbol, 'price': number(price) } for symbol, price in market.prices.items()])
+        elif symbol not in market.prices:
+            self.reply(400, { 'code': -1121, 'msg': 'Invalid symbol.' })
+        elif path == '/ticker/price':
+            self.reply(200, { 'symbol': symbol, 'price': number(market.prices[symbol]) })
+        elif path == '/depth':
+            book = market.book(symbol)
+            self.reply(200, { 'lastUpdateId': market.steps, 'bids': book['bids'], 'asks': book['asks'] })
+        elif path == '/klines':
+            interval = INTERVALS.get(query.get('interval', ['1m'])[0])
+            if interval is None:
+                return self.reply(400, { 'code': -1120, 'msg': 'Invalid interval.' })
+            candles = market.ohlc(symbol, interval, max(1, min(int(query.get('limit', ['500'])[0]), 1000)))
+            self.reply(200, [[start * 1000, number(open), number(high), number(low), number(close), number(volume), (start + interval) * 1000 - 1]
+                for start, open, high, low, close, volume in candles])
+        else:
+            self.reply(404, {})
+
+    def reply(self, code, body, headers=dict()):
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def websocket(self, path):
+        """ Stream the trades of the subscribed pairs until the client disconnects """
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            return self.reply(400, { 'error': 'WebSocket upgrade expected' })
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.wfile.write(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+        self.close_connection = True
+        binance = path != '/ws' # Binance names the streams in the path, Bitstamp clients subscribe to channels
+        subscribed = set(stream.split('@')[0].upper() for stream in path[len('/ws/'):].split('/') if stream.endswith('@trade')) if binance else set()
+        trades, closed, write = queue.Queue(), threading.Event(), threading.Lock()
+        def send(message, opcode=0x1):
+            with write:
+                self.wfile.write(frame(message if opcode != 0x1 else json.dumps(message).encode(), opcode))
+        def receive():
+            try:
+                while True:
+                    opcode, payload = read_frame(self.rfile)
+                    if opcode is None or opcode == 0x8:
+                        return
+                    if opcode == 0x9:
+                        send(payload, 0xA)
+                    elif opcode == 0x1 and not binance:
+                        self.subscribe(json.loads(payload), subscribed, send)
+            except (OSError, ValueError):
+                pass
+            finally:
+                closed.set()
+        threading.Thread(target=receive, daemon=True).start()
+        self.market.listeners.add(trades)
+        try:
+            while not closed.is_set():
+                try:
+                    symbol, trade = trades.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if symbol in subscribed:
+                    send(binance_trade(symbol, trade) if binance else bitstamp_trade(symbol, trade))
+        except OSError:
+            pass
+        finally:
+            self.market.listeners.discard(trades)
+
+    def subscribe(self, message, subscribed, send):
+        """ Bitstamp bts:subscribe, bts:unsubscribe and bts:heartbeat events """
+        event, channel = message.get('event'), (message.get('data') or {}).get('channel', '')
+        symbol = channel[len('live_trades_'):].upper() if channel.startswith('live_trades_') else None
+        if event == 'bts:heartbeat':
+            send({ 'event': 'bts:heartbeat', 'channel': '', 'data': { 'status': 'success' } })
+        elif event in ('bts:subscribe', 'bts:unsubscribe') and symbol in self.market.prices:
+            (subscribed.add if event == 'bts:subscribe' else subscribed.discard)(symbol)
+            send({ 'event': SUBSCRIPTION_EVENTS[event], 'channel': channel, 'data': {} })
+        else:
+            send({ 'event': 'bts:error', 'channel': channel, 'data': { 'code': None, 'message': "Bad subscription string." } })
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host='127.0.0.1', port=PORT):
+    """ Serve MockExchange on a background thread, port 0 picks a free port """
+    server = ThreadingHTTPServer((host, port), MockExchange)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local mock of the Bitstamp and Binance endpoints used by the bot")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--csv', default=None, help="replay prices from this file, one row per tick (a column per pair, e.g. BTC/USD)")
+    parser.add_argument('--tick', type=float, default=TICK_SECONDS, help="seconds between price steps")
+    parser.add_argument('--volatility', type=float, default=VOLATILITY, help="random walk standard deviation per tick")
+    parser.add_argument('--seed', type=int, default=None, help="random walk seed")
+    parser.add_argument('--latency', type=float, default=0, help="latency per request (ms)")
+    parser.add_argument('--jitter', type=float, default=0, help="random extra latency per request, up to (ms)")
+    parser.add_argument('--errors', type=float, default=0, help="fraction of requests answered with a 500 error")
+    parser.add_argument('--rate-limit', type=int, default=0, help="requests per minute and exchange before 429 responses")
+    args = parser.parse_args(argv)
+
+    if args.csv:
+        replay = Market.load(args.csv)
+        MockExchange.market = Market(replay[0], replay=replay)
+    else:
+        MockExchange.market = Market(volatility=args.volatility, seed=args.seed)
+    MockExchange.latency, MockExchange.jitter = args.latency / 1000, args.jitter / 1000
+    MockExchange.error_rate, MockExchange.rate_limit = args.errors, args.rate_limit
+    MockExchange.market.step()
+    server = serve(args.host, args.port)
+    url = f"http://{args.host}:{server.server_address[1]}"
+    print(f"Mock exchange serving {len(MockExchange.market.prices)} pairs on {url}")
+    print(json.dumps({ 'base_urls': { 'Bitstamp': url + '/api/v2', 'Binance': url } }))
+    try:
+        MockExchange.market.run(args.tick)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Integer fixed-point money.
+
+Amounts are ints in the smallest unit of their currency (10^-scale), prices are ints in 10^-PRICE_SCALE
+quote units per base unit and fee rates are ints in parts per million.
+
+Rounding rules: costs of a BUY and every fee round up, proceeds of a SELL and valuations round down,
+so the ledger never credits more than the exchange would.
+"""
+
+from fractions import Fraction
+from functools import lru_cache
+
+DEFAULT_SCALE = 8 # satoshi-like units
+
+SCALES = {
+    'USD': 6, 'EUR': 6, 'GBP': 6, 'JPY': 4, 'USDT': 6, 'USDC': 6, 'BUSD': 6, 'PAX': 6,
+    'BTC': 8, 'ETH': 8, 'LTC': 8, 'BCH': 8, 'XRP': 6
+}
+
+PRICE_SCALE = 8
+
+RATE_SCALE = 10 ** 6 # fee rates in parts per million
+
+def scale(currency):
+    return SCALES.get(currency.upper(), DEFAULT_SCALE)
+
+def units(value, currency, scale_digits=None):
+    """ Exact conversion of a number (int, float, str or Decimal) to units, rounding half to even """
+    digits = scale(currency) if scale_digits is None else scale_digits
+    if isinstance(value, int):
+        return value * 10 ** digits
+    return round(Fraction(value) * 10 ** digits)
+
+def value(amount, currency, scale_digits=None):
+    """ Float value of an amount in units, only for display and ratios """
+    return amount / 10 ** (scale(currency) if scale_digits is None else scale_digits)
+
+def price(current):
+    """ Price units of a quote """
+    return units(current, '', PRICE_SCALE)
+
+def rate(fee):
+    """ Fee rate (e.g. 0.005 for 0.5%) in parts per million """
+    return round(Fraction(fee) * RATE_SCALE)
+
+@lru_cache(maxsize=None)
+def __shift(base, quote):
+    """ (divisor, multiplier) from amount * price units to quote units """
+    shift = scale(base) + PRICE_SCALE - scale(quote)
+    return (10 ** shift, 1) if shift >= 0 else (1, 10 ** -shift)
+
+def cost(amount, base, current, quote, up=False):
+    """ Value in quote units of an amount of base units at a price in price units """
+    divisor, multiplier = __shift(base, quote)
+    if up:
+        return -(-amount * current * multiplier // divisor)
+    return amount * current * multiplier // divisor
+
+def affordable(total, quote, current, base):
+    """ Maximum base units that cost at most total quote units at a price in price units """
+    divisor, multiplier = __shift(base, quote)
+    return total * divisor // (current * multiplier)
+
+def fee(amount, fee_rate):
+    """ Fee in units for an amount in units and a rate in parts per million, rounded up """
+    return -(-amount * fee_rate // RATE_SCALE)
+
+def fmt(amount, currency, precision=None, scale_digits=None):
+    """ Exact decimal representation of an amount in units, truncated to precision decimals """
+    digits = scale(currency) if scale_digits is None else scale_digits
+    sign = '-' if amount < 0 else ''
+    whole, fraction = divmod(abs(amount), 10 ** digits)
+    fraction = str(fraction).rjust(digits, '0') if digits else ''
+    if precision is not None:
+        fraction = fraction[:precision]
+    fraction = fraction.rstrip('0') if precision is None or precision > 2 else fraction
+    return f"{sign}{whole}.{fraction}" if fraction else f"{sign}{whole}"
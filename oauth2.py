@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 #
 # Copyright 2012 Google Inc.
 #
@@ -66,7 +66,8 @@ import json
 from optparse import OptionParser
 import smtplib
 import sys
-import urllib
+import urllib.parse
+import urllib.request
 
 
 def SetupOptionParser():
@@ -124,26 +125,27 @@ GOOGLE_ACCOUNTS_BASE_URL = 'https://accounts.google.com'
 REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
 
 
-def AccountsUrl(command):
+def AccountsUrl(command, base_url=None):
   """Generates the Google Accounts URL.
 
   Args:
     command: The command to execute.
+    base_url: Accounts server root, GOOGLE_ACCOUNTS_BASE_URL by default.
 
   Returns:
     A URL for the given command.
   """
-  return '%s/%s' % (GOOGLE_ACCOUNTS_BASE_URL, command)
+  return '%s/%s' % (base_url or GOOGLE_ACCOUNTS_BASE_URL, command)
 
 
 def UrlEscape(text):
   # See OAUTH 5.1 for a definition of which characters need to be escaped.
-  return urllib.quote(text, safe='~-._')
+  return urllib.parse.quote(text, safe='~-._')
 
 
 def UrlUnescape(text):
   # See OAUTH 5.1 for a definition of which characters need to be escaped.
-  return urllib.unquote(text)
+  return urllib.parse.unquote(text)
 
 
 def FormatUrlParams(params):
@@ -156,7 +158,7 @@ def FormatUrlParams(params):
     A URL query string version of the given parameters.
   """
   param_fragments = []
-  for param in sorted(params.iteritems(), key=lambda x: x[0]):
+  for param in sorted(params.items(), key=lambda x: x[0]):
     param_fragments.append('%s=%s' % (param[0], UrlEscape(param[1])))
   return '&'.join(param_fragments)
 
@@ -205,11 +207,13 @@ def AuthorizeTokens(client_id, client_secret, authorization_code):
   params['grant_type'] = 'authorization_code'
   request_url = AccountsUrl('o/oauth2/token')
 
-  response = urllib.urlopen(request_url, urllib.urlencode(params)).read()
+  response = urllib.request.urlopen(
+      request_url, urllib.parse.urlencode(params).encode()).read()
   return json.loads(response)
 
 
-def RefreshToken(client_id, client_secret, refresh_token):
+def RefreshToken(client_id, client_secret, refresh_token, base_url=None,
+                 timeout=None):
   """Obtains a new token given a refresh token.
 
   See https://developers.google.com/accounts/docs/OAuth2InstalledApp#refresh
@@ -218,6 +222,8 @@ def RefreshToken(client_id, client_secret, refresh_token):
     client_id: Client ID obtained by registering your app.
     client_secret: Client secret obtained by registering your app.
     refresh_token: A previously-obtained refresh token.
+    base_url: Accounts server root, GOOGLE_ACCOUNTS_BASE_URL by default.
+    timeout: Request timeout in seconds.
   Returns:
     The decoded response from the Google Accounts server, as a dict. Expected
     fields include 'access_token', 'expires_in', and 'refresh_token'.
@@ -227,9 +233,11 @@ def RefreshToken(client_id, client_secret, refresh_token):
   params['client_secret'] = client_secret
   params['refresh_token'] = refresh_token
   params['grant_type'] = 'refresh_token'
-  request_url = AccountsUrl('o/oauth2/token')
+  request_url = AccountsUrl('o/oauth2/token', base_url)
 
-  response = urllib.urlopen(request_url, urllib.urlencode(params)).read()
+  response = urllib.request.urlopen(
+      request_url, urllib.parse.urlencode(params).encode(),
+      timeout=timeout).read()
   return json.loads(response)
 
 
@@ -248,7 +256,7 @@ def GenerateOAuth2String(username, access_token, base64_encode=True):
   """
   auth_string = 'user=%s\1auth=Bearer %s\1\1' % (username, access_token)
   if base64_encode:
-    auth_string = base64.b64encode(auth_string)
+    auth_string = base64.b64encode(auth_string.encode()).decode()
   return auth_string
 
 
@@ -262,7 +270,7 @@ def TestImapAuthentication(user, auth_string):
     auth_string: A valid OAuth2 string, as returned by GenerateOAuth2String.
         Must not be base64-encoded, since imaplib does its own base64-encoding.
   """
-  print
+  print()
   imap_conn = imaplib.IMAP4_SSL('imap.gmail.com')
   imap_conn.debug = 4
   imap_conn.authenticate('XOAUTH2', lambda x: auth_string)
@@ -277,18 +285,18 @@ def TestSmtpAuthentication(user, auth_string):
     auth_string: A valid OAuth2 string, not base64-encoded, as returned by
         GenerateOAuth2String.
   """
-  print
+  print()
   smtp_conn = smtplib.SMTP('smtp.gmail.com', 587)
   smtp_conn.set_debuglevel(True)
   smtp_conn.ehlo('test')
   smtp_conn.starttls()
-  smtp_conn.docmd('AUTH', 'XOAUTH2 ' + base64.b64encode(auth_string))
+  smtp_conn.docmd('AUTH', 'XOAUTH2 ' + base64.b64encode(auth_string.encode()).decode())
 
 
 def RequireOptions(options, *args):
   missing = [arg for arg in args if getattr(options, arg) is None]
   if missing:
-    print 'Missing options: %s' % ' '.join(missing)
+    print('Missing options: %s' % ' '.join(missing))
     sys.exit(-1)
 
 
@@ -299,22 +307,22 @@ def main(argv):
     RequireOptions(options, 'client_id', 'client_secret')
     response = RefreshToken(options.client_id, options.client_secret,
                             options.refresh_token)
-    print 'Access Token: %s' % response['access_token']
-    print 'Access Token Expiration Seconds: %s' % response['expires_in']
+    print('Access Token: %s' % response['access_token'])
+    print('Access Token Expiration Seconds: %s' % response['expires_in'])
   elif options.generate_oauth2_string:
     RequireOptions(options, 'user', 'access_token')
     print ('OAuth2 argument:\n' +
            GenerateOAuth2String(options.user, options.access_token))
   elif options.generate_oauth2_token:
     RequireOptions(options, 'client_id', 'client_secret')
-    print 'To authorize token, visit this url and follow the directions:'
-    print '  %s' % GeneratePermissionUrl(options.client_id, options.scope)
-    authorization_code = raw_input('Enter verification code: ')
+    print('To authorize token, visit this url and follow the directions:')
+    print('  %s' % GeneratePermissionUrl(options.client_id, options.scope))
+    authorization_code = input('Enter verification code: ')
     response = AuthorizeTokens(options.client_id, options.client_secret,
                                 authorization_code)
-    print 'Refresh Token: %s' % response['refresh_token']
-    print 'Access Token: %s' % response['access_token']
-    print 'Access Token Expiration Seconds: %s' % response['expires_in']
+    print('Refresh Token: %s' % response['refresh_token'])
+    print('Access Token: %s' % response['access_token'])
+    print('Access Token Expiration Seconds: %s' % response['expires_in'])
   elif options.test_imap_authentication:
     RequireOptions(options, 'user', 'access_token')
     TestImapAuthentication(options.user,
@@ -327,7 +335,7 @@ def main(argv):
                              base64_encode=False))
   else:
     options_parser.print_help()
-    print 'Nothing to do, exiting.'
+    print('Nothing to do, exiting.')
     return
 
 
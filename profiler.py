@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in sampling profiler for command handlers.
+
+While the profiler is on, a fraction of handler invocations is sampled: a sampler thread records the stack of every
+sampled invocation each INTERVAL_SECONDS, down to the exchange, IMAP and trading functions the handler calls. Stacks are
+aggregated in memory as collapsed stacks (frames root first separated by ';' and a sample count, the input format of
+flamegraph.pl and speedscope). At most MAX_STACKS distinct stacks are kept, further samples count as [truncated].
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+
+from datetime import datetime
+
+SAMPLE_RATE = 0.1 # fraction of handler invocations profiled
+
+INTERVAL_SECONDS = 0.005
+
+MAX_DEPTH = 64 # frames kept per stack, from the handler down
+
+MAX_STACKS = 10000
+
+DIRECTORY = 'profiles'
+
+ENABLED = False
+
+rate = SAMPLE_RATE
+interval = INTERVAL_SECONDS
+
+STACKS = dict() # collapsed stack to samples
+ACTIVE = dict() # thread id to (handler name, handler frame) of the sampled invocations running now
+
+invocations = 0
+sampled = 0
+started = None
+
+__lock = threading.Lock()
+__sampler = None
+
+def profiled(name, handler):
+    """ Handler sampled at rate while the profiler is on """
+    def response(*args, **kwargs):
+        global invocations, sampled
+        if not ENABLED:
+            return handler(*args, **kwargs)
+        invocations += 1
+        if random.random() >= rate:
+            return handler(*args, **kwargs)
+        sampled += 1
+        ident = threading.get_ident()
+        ACTIVE[ident] = (name, sys._getframe())
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            ACTIVE.pop(ident, None)
+    return response
+
+def __frame(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename).replace('.py', '')}:{code.co_name}"
+
+def __stack(name, root, frame):
+    """ Collapsed stack from the handler frame (excluded) to frame """
+    frames = []
+    while frame is not None and frame is not root:
+        frames.append(__frame(frame))
+        frame = frame.f_back
+    return ';'.join([name] + frames[::-1][:MAX_DEPTH])
+
+def __sample():
+    frames = sys._current_frames()
+    stacks = [__stack(name, root, frames[ident]) for ident, (name, root) in list(ACTIVE.items()) if ident in frames]
+    del frames
+    with __lock:
+        for stack in stacks:
+            if stack in STACKS or len(STACKS) < MAX_STACKS:
+                STACKS[stack] = STACKS.get(stack, 0) + 1
+            else:
+                STACKS['[truncated]'] = STACKS.get('[truncated]', 0) + 1
+
+def __run():
+    while ENABLED:
+        time.sleep(interval)
+        if ACTIVE:
+            __sample()
+
+def start(sample_rate=SAMPLE_RATE, sample_interval=INTERVAL_SECONDS):
+    global ENABLED, rate, interval, started, __sampler
+    rate, interval = min(max(sample_rate, 0), 1), sample_interval
+    if ENABLED:
+        return
+    ENABLED = True
+    started = started or datetime.now()
+    __sampler = threading.Thread(target=__run, name='profiler', daemon=True)
+    __sampler.start()
+
+def stop():
+    global ENABLED
+    ENABLED = False
+    if __sampler is not None:
+        __sampler.join()
+
+def reset():
+    global invocations, sampled, started
+    with __lock:
+        STACKS.clear()
+    invocations = sampled = 0
+    started = datetime.now() if ENABLED else None
+
+def collapsed():
+    """ Collapsed stacks, most sampled first """
+    with __lock:
+        stacks = sorted(STACKS.items(), key=lambda item: item[1], reverse=True)
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+def top(n=20):
+    """ (function, self samples, total samples) of the n functions with most self samples, and the total samples """
+    own, total = dict(), dict()
+    with __lock:
+        stacks = list(STACKS.items())
+    for stack, count in stacks:
+        frames = stack.split(';')
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for frame in set(frames):
+            total[frame] = total.get(frame, 0) + count
+    ranked = sorted(own, key=lambda frame: (own[frame], total[frame]), reverse=True)[:n]
+    return [(frame, own[frame], total[frame]) for frame in ranked], sum(count for _, count in stacks)
+
+def save(file=None):
+    """ Write the collapsed stacks to file (by default a new file in DIRECTORY), returns its path """
+    if file is None:
+        os.makedirs(DIRECTORY, exist_ok=True)
+        file = os.path.join(DIRECTORY, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+    with open(file, 'w') as profile_file:
+        profile_file.write(collapsed())
+    return file
+
+def summary(n=20):
+    """ Profiler state and top functions as a message """
+    state = f"on, {rate * 100:g}% of invocations every {interval * 1000:g} ms" if ENABLED else 'off'
+    text = f"Profiler: {state}"
+    if started:
+        text += f"\nSince: {started.strftime('%d-%m-%Y %H:%M:%S')}"
+    functions, samples = top(n)
+    text += f"\nSampled invocations: {sampled} of {invocations}\nSamples: {samples}"
+    if functions:
+        text += "\n\nTop functions (self, total):"
+        for frame, own, total in functions:
+            text += f"\n{own * 100 / samples:5.1f}% {total * 100 / samples:5.1f}% {frame}"
+    return text
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rendered-response cache.
+
+Static replies are rendered once per variant, e.g. ('help', superuser) or ('list', exchange, currency),
+and split into pages that fit in a Telegram message. Listings are invalidated when a symbol index changes.
+"""
+
+import api
+import metrics
+import threading
+
+MAX_LENGTH = 4096 # Telegram message limit
+
+__lock = threading.Lock()
+
+CACHE = dict() # (name, *variant) to list of pages
+
+def paginate(text, limit=MAX_LENGTH):
+    """ Split text into pages of at most limit characters, at line breaks when possible """
+    pages = []
+    page = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if page:
+                pages.append(page)
+                page = ''
+            pages.append(line[:limit])
+            line = line[limit:]
+        if page and len(page) + 1 + len(line) > limit:
+            pages.append(page)
+            page = line
+        else:
+            page = f"{page}\n{line}" if page else line
+    pages.append(page)
+    return pages
+
+def pages(key, f, limit=MAX_LENGTH):
+    """ Cached pages of the text rendered by f() for key """
+    rendered = CACHE.get(key)
+    if rendered is not None:
+        metrics.hit('responses')
+        return rendered
+    metrics.miss('responses')
+    rendered = paginate(f(), limit)
+    with __lock:
+        CACHE[key] = rendered
+    return rendered
+
+def page(key, f, index=0, limit=MAX_LENGTH):
+    """ (page text, page index, page count) of the cached pages for key, index clamped to the available pages """
+    rendered = pages(key, f, limit)
+    index = min(max(index, 0), len(rendered) - 1)
+    return rendered[index], index, len(rendered)
+
+def invalidate(*prefix):
+    """ Drop the cached responses whose key starts with prefix, e.g. ('list', 'Bitstamp'), or every response """
+    with __lock:
+        for key in [key for key in CACHE if key[:len(prefix)] == prefix]:
+            del CACHE[key]
+
+api.PAIRS_LISTENERS.append(lambda exchange: invalidate('list', exchange.name))
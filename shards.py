@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sharded execution: accounts are partitioned by user hash across worker processes.
+
+The front-end process keeps Telegram I/O and routes trading calls to the worker owning the user over a pipe.
+Each worker owns its slice of trading.ACCOUNTS and saves it on stop. Quotes fetched by a worker and the symbol
+index refreshed by the front-end are relayed to every shard, so market data is shared.
+"""
+
+import zlib
+import logging
+import itertools
+import threading
+import multiprocessing
+
+from concurrent.futures import Future, TimeoutError
+
+import api
+import logs
+import config
+import memory
+import snapshot
+import trading
+import exposure
+
+CALL_TIMEOUT_SECONDS = 30
+
+ROUTES = { # function name to the user owning the call, by default the first argument
+    'account': lambda bot_name, user, superuser, other: other or user,
+    'history': lambda bot_name, user, superuser, other: other or user
+}
+
+LOCAL = set(['ping']) # calls served by the front-end
+
+def shard(user, shards):
+    """ Stable shard index of a user (hash() is randomized per process) """
+    return zlib.crc32(str(user).encode('utf-8')) % shards
+
+# WORKER
+
+def __relay_ticks(send, relaying):
+    """ Send the ticks of this process to the front-end, except those of relayed market data """
+    def tick(exchange, pair, price):
+        if not getattr(relaying, 'active', False):
+            try:
+                send(('market', 'tick', exchange.name, (pair, price)))
+            except OSError: # the front-end is gone, the worker is stopping
+                pass
+    api.TICK_LISTENERS.append(tick)
+
+def apply_market(kind, name, payload):
+    """ Apply a tick or a symbol index relayed from another process """
+    exchange = api.get_api(name)
+    if exchange is None:
+        return
+    if kind == 'tick':
+        exchange.tick(*payload)
+    elif kind == 'pairs':
+        exchange.set_pairs(payload)
+
+def worker(index, shards, conn):
+    """ Worker process loop: serve calls for the users of this shard until stopped """
+    logs.setup(file=None)
+    if config.get('tracemalloc'):
+        memory.start()
+    file = f"{snapshot.FILE}-shard{index}"
+    state = snapshot.load(file)
+    restored = state is not None and state['shards'] == shards # users move between shards when their number changes
+    if restored:
+        trading.accounts().exposure.restore(state['exposure'])
+    trading.load(lazy=True, owns=lambda user: shard(user, shards) == index, indexed=restored)
+    lock = threading.Lock() # results are sent by this thread, ticks by the exchange pool threads
+    def send(message):
+        with lock:
+            conn.send(message)
+    relaying = threading.local() # set on the thread applying relayed market data
+    __relay_ticks(send, relaying)
+    logs.event('shard_started', shard=index)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == 'call':
+            _, call_id, name, args = message
+            try:
+                send(('result', call_id, True, getattr(trading, name)(*args)))
+            except Exception as e:
+                logs.exception('shard_call_failed', shard=index, call=name)
+                send(('result', call_id, False, f"{type(e).__name__}: {e}"))
+        elif message[0] == 'market':
+            relaying.active = True
+            try:
+                apply_market(*message[1:])
+            finally:
+                relaying.active = False
+        elif message[0] == 'stop':
+            break
+    trading.save()
+    snapshot.save({ 'shards': shards, 'exposure': trading.exposure_totals() }, file)
+    logs.event('shard_stopped', shard=index)
+    logs.stop()
+
+# FRONT-END
+
+class Shard:
+
+    def __init__(self, router, index):
+        self.router = router
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.lock = threading.RLock() # serializes sends and restarts
+        self.pending = dict() # call id to Future
+        self.calls = 0
+        self.restarts = -1
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        conn, child = context.Pipe()
+        self.process = context.Process(target=worker, args=(self.index, len(self.router.shards), child), name=f'shard-{self.index}', daemon=True)
+        self.process.start()
+        child.close()
+        self.conn = conn
+        self.pending = dict() # calls sent on this connection, failed by its reader when it closes
+        self.restarts += 1
+        threading.Thread(target=self.read, args=(conn, self.pending), name=f'shard-{self.index}-reader', daemon=True).start()
+        for exchange in api.APIS.values():
+            if exchange.pairs:
+                self.send(('market', 'pairs', exchange.name, exchange.pairs))
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def read(self, conn, pending):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'result':
+                _, call_id, ok, value = message
+                future = pending.pop(call_id, None)
+                if future is not None:
+                    future.set_result(value) if ok else future.set_exception(RuntimeError(value))
+            elif message[0] == 'market':
+                self.router.market(message, source=self)
+        for call_id in list(pending):
+            future = pending.pop(call_id, None)
+            if future is not None and not future.done():
+                future.set_exception(RuntimeError(f"Shard {self.index} stopped"))
+
+    def restart(self):
+        logs.event('shard_restart', level=logging.WARNING, shard=self.index)
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        self.start()
+
+    def call(self, call_id, name, args):
+        with self.lock:
+            if not self.alive():
+                self.restart()
+            self.calls += 1
+            try:
+                return self.__send_call(call_id, name, args)
+            except OSError: # the worker died but is not reaped yet
+                self.restart()
+                return self.__send_call(call_id, name, args)
+
+    def __send_call(self, call_id, name, args):
+        future = Future()
+        self.pending[call_id] = future
+        self.conn.send(('call', call_id, name, args))
+        return future
+
+    def stop(self):
+        if self.alive():
+            try:
+                self.send(('stop',))
+            except OSError: # the worker is dying already
+                self.process.kill()
+            self.process.join()
+
+class Router:
+    """ Same interface as the trading module, routing every call to the shard owning its user """
+
+    def __init__(self, shards):
+        self.shards = [Shard(self, i) for i in range(shards)]
+        self.ids = itertools.count()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def restart(self, index):
+        shard = self.shards[index]
+        shard.stop()
+        with shard.lock:
+            shard.start()
+
+    def market(self, message, source=None):
+        """ Apply market data locally and relay it to every other shard """
+        apply_market(*message[1:])
+        for shard in self.shards:
+            if shard is not source and shard.alive():
+                try:
+                    shard.send(message)
+                except (OSError, BrokenPipeError):
+                    pass
+
+    def call(self, name, *args):
+        user = ROUTES.get(name, lambda user, *_: user)(*args)
+        future = self.shards[shard(user, len(self.shards))].call(next(self.ids), name, args)
+        try:
+            return future.result(timeout=CALL_TIMEOUT_SECONDS)
+        except TimeoutError:
+            return "Sorry, the request timed out. Please, try again."
+        except RuntimeError as e: # the shard stopped or the call failed in the worker
+            logs.event('shard_call_failed', level=logging.WARNING, call=name, error=str(e))
+            return "Sorry, the request failed. Please, try again."
+
+    def __getattr__(self, name):
+        if name in LOCAL:
+            return getattr(trading, name)
+        return lambda *args: self.call(name, *args)
+
+    def refresh_pairs(self):
+        """ Refresh the symbol index once and share it with every shard """
+        for exchange in api.APIS.values():
+            if isinstance(exchange.refresh_pairs(), list):
+                self.market(('market', 'pairs', exchange.name, exchange.pairs))
+
+    def save(self):
+        """ Save the accounts of every shard, the shards save concurrently """
+        futures = [shard.call(next(self.ids), 'save', ()) for shard in self.shards if shard.alive()]
+        for future in futures:
+            future.result(timeout=CALL_TIMEOUT_SECONDS)
+
+    def memory(self):
+        """ Memory report of every shard """
+        reports = [(shard, shard.call(next(self.ids), 'memory', ())) for shard in self.shards]
+        return '\n\n'.join(f"Shard {shard.index}\n{future.result(timeout=CALL_TIMEOUT_SECONDS)}" for shard, future in reports)
+
+    def export_all(self):
+        """ Export the account files of every shard, once saved """
+        self.save()
+        return trading.export_all()
+
+    def exposure(self):
+        """ Exposure of the accounts of every shard """
+        futures = [shard.call(next(self.ids), 'exposure_totals', ()) for shard in self.shards]
+        return exposure.report(exposure.merge(future.result(timeout=CALL_TIMEOUT_SECONDS) for future in futures))
+
+    def status(self):
+        text = f"Shards: {len(self.shards)}"
+        for shard in self.shards:
+            state = f"pid {shard.process.pid}" if shard.alive() else "stopped"
+            text += f"\n{shard.index}: {state}, {shard.calls} calls, {len(shard.pending)} pending, {shard.restarts} restarts"
+        return text
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""
+Warm-start snapshot: the whole bot state in one binary file, written on shutdown and restored with a single read.
+"""
+
+import os
+import pickle
+import logs
+
+FILE = 'snapshot'
+VERSION = 5
+
+def save(state, file=FILE):
+    """ Atomically write the state (a dict of picklable values) """
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as snapshot_file:
+        snapshot_file.write(pickle.dumps((VERSION, state), protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, file)
+
+def load(file=FILE, consume=True):
+    """
+    Read the state written by save, or None if there is no valid snapshot.
+
+    consume: remove the snapshot once read, so a crash never restores older state than the accounts on disk
+    """
+    try:
+        with open(file, 'rb') as snapshot_file:
+            version, state = pickle.loads(snapshot_file.read())
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logs.exception('snapshot_invalid', file=file)
+        return None
+    finally:
+        if consume and os.path.exists(file):
+            os.remove(file)
+    if version != VERSION:
+        logs.event('snapshot_version_mismatch', file=file, version=version)
+        return None
+    return state
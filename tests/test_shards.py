@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shard failures seen from the front-end, against the mock exchange:
+
+    python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shards
+import mockexchange
+from mockexchange import Market, MockExchange
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory(prefix='kitraderbot-test-')
+        os.chdir(self.directory.name) # workers read config.json and accounts/ from here
+        MockExchange.market = Market({ 'BTC/USD': 100.0 }, volatility=0)
+        MockExchange.latency = 5 # longer than the call, shorter than CALL_TIMEOUT_SECONDS
+        self.server = mockexchange.serve(port=0)
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        with open('config.json', 'w') as config_file:
+            json.dump({ 'base_urls': { 'Bitstamp': url + '/api/v2', 'Binance': url } }, config_file)
+        self.router = shards.Router(1)
+        self.router.start()
+
+    def tearDown(self):
+        self.router.stop()
+        self.server.shutdown()
+        MockExchange.latency = 0
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_shard_killed_mid_call(self):
+        threading.Timer(1, self.router.shards[0].process.kill).start()
+        start = time.monotonic()
+        self.assertEqual(self.router.price('user', 'BTCUSD'), "Sorry, the request failed. Please, try again.")
+        self.assertLess(time.monotonic() - start, shards.CALL_TIMEOUT_SECONDS)
+        # the next call restarts the shard
+        MockExchange.latency = 0
+        self.assertIn('100', self.router.price('user', 'BTCUSD'))
+        self.assertEqual(self.router.shards[0].restarts, 1)
+
+if __name__ == '__main__':
+    unittest.main()
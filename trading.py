@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import threading
+import api
+import money
+import config
+import metrics
+import execution
+import lots
+import export
+import render
+import memory as memory_report
+import exposure as exposure_index
+import bitstamp, binance # register available exchanges
+from account import Account, symbol_of
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+ORDERS = set(['BUY', 'SELL'])
+
+QUOTE_TIMEOUT_SECONDS = 3
+
+EXCHANGE_WORKERS = 8 # concurrent /quote and /ping calls per exchange
+
+MAX_BATCH_ORDERS = 50
+
+DEPTH_FILLS = config.get('depth_fills', True) # fill /trade and /tradeAll at the VWAP of the order book
+
+BATCH_SYNTAX = "/batch followed by one order per line (or separated by ;)\n[BUY, SELL] [amount, ALL] symbol\n# optional comment\n\ne.g.\n/batch\nSELL ALL ETH\nBUY 0.1 BTC\n# rebalance"
+
+class Accounts(dict):
+    """
+    user to Account, accounts not in memory are read from directory on first access.
+    Accounts report their position changes to the exposure index of the accounts they are in.
+    """
+
+    def __init__(self, directory='accounts'):
+        super().__init__()
+        self.directory = directory
+        self.exposure = exposure_index.Index()
+
+    def __setitem__(self, user, account):
+        account._exposure = self.exposure
+        super().__setitem__(user, account)
+
+    def update(self, accounts):
+        for user, account in accounts.items():
+            self[user] = account
+
+    def remove(self, user):
+        """ Remove the account of user, and its positions from the exposure index """
+        account = self.pop(user)
+        self.exposure.remove(account)
+        account._exposure = None
+        return account
+
+    def file(self, user):
+        return os.path.join(self.directory, user)
+
+    def __load(self, user):
+        if not isinstance(user, str) or '/' in user:
+            return None
+        file = self.file(user)
+        if not os.path.isfile(file):
+            return None
+        account = Account.load(file)
+        self[user] = account
+        return account
+
+    def __missing__(self, user):
+        account = self.__load(user)
+        if account is None:
+            raise KeyError(user)
+        return account
+
+    def __contains__(self, user):
+        return dict.__contains__(self, user) or self.__load(user) is not None
+
+ACCOUNTS = Accounts()
+
+LOCAL = threading.local() # accounts of the tenant served by the current thread, see using
+
+def accounts():
+    """ Accounts of the tenant bound to the current thread, ACCOUNTS by default """
+    return getattr(LOCAL, 'accounts', ACCOUNTS)
+
+@contextmanager
+def using(tenant_accounts):
+    """ Bind the trading functions of the current thread to the accounts of a tenant """
+    previous = getattr(LOCAL, 'accounts', ACCOUNTS)
+    LOCAL.accounts = tenant_accounts
+    try:
+        yield
+    finally:
+        LOCAL.accounts = previous
+
+class Engine:
+    """ Trading functions of this module bound to the accounts of a tenant, like a shards.Router """
+
+    def __init__(self, tenant_accounts):
+        self.accounts = tenant_accounts
+
+    def __getattr__(self, name):
+        f = globals().get(name)
+        if not callable(f) or isinstance(f, type):
+            raise AttributeError(name)
+        def bound(*args, **kwargs):
+            with using(self.accounts):
+                return f(*args, **kwargs)
+        return bound
+
+# one pool per exchange: calls to a hung exchange keep running after their deadline, without delaying the other exchanges
+EXCHANGES = { exchange.name: ThreadPoolExecutor(max_workers=EXCHANGE_WORKERS, thread_name_prefix=f'exchange-{exchange.name}') for exchange in api.APIS.values() }
+for exchange in api.APIS.values():
+    metrics.gauge('queue_depth', EXCHANGES[exchange.name]._work_queue.qsize, queue='exchanges', service=exchange.name)
+    metrics.gauge('circuit_open', lambda exchange=exchange: int(exchange.circuit.is_open()), service=exchange.name)
+
+def __exchange(user):
+    return accounts()[user].exchange() if existsAccount(user) else api.get_api(api.DEFAULT)
+
+def __currency(user):
+    return accounts()[user].currency if existsAccount(user) else 'USD'
+
+def __gather(f, timeout=QUOTE_TIMEOUT_SECONDS):
+    """ Call f(exchange) for every exchange concurrently, returns a list of (exchange, result or None if timed out) """
+    futures = [(exchange, EXCHANGES[exchange.name].submit(f, exchange)) for exchange in api.APIS.values()]
+    wait([future for _, future in futures], timeout=timeout)
+    def result(future):
+        try:
+            return future.result(timeout=0)
+        except Exception as e:
+            return e
+    return [(exchange, result(future) if future.done() else None) for exchange, future in futures]
+
+def ping():
+    return '\n'.join(str(result) if result is not None else f"{exchange} API: Timed out" for exchange, result in __gather(lambda exchange: exchange.ping()))
+
+def list_symbols(user, page=0):
+    """ (text, page, pages) of the symbols listing for the exchange and currency of the user """
+    exchange = __exchange(user)
+    currency = __currency(user) if existsAccount(user) else None
+    if exchange.pairs is None and not isinstance(exchange.refresh_pairs(), list):
+        return exchange.list_symbols(currency), 0, 1 # error message, not cached
+    return render.page(('list', exchange.name, currency), lambda: exchange.list_symbols(currency), page)
+
+def price(user, symbol):
+    if not symbol:
+        symbol = f'BTC{__currency(user)}'
+    return __exchange(user).price(symbol)
+
+def quote(user, symbol):
+    if not symbol:
+        symbol = f'BTC{__currency(user)}'
+    symbol = symbol.upper()
+    quotes = []
+    text = f"{symbol} quotes:\n"
+    for exchange, current in __gather(lambda exchange: exchange.get_price(symbol)):
+        if isinstance(current, float):
+            quotes.append((current, exchange))
+            text += f"\n{exchange}: {current}" + (f" (stale, {round(current.age)}s old)" if isinstance(current, api.StalePrice) else '')
+        elif current is None:
+            text += f"\n{exchange}: Timed out"
+        else:
+            text += f"\n{exchange}: Not available"
+    if not quotes:
+        return f"{text}\n\nNo exchange quoted {symbol}. See /list"
+    lowest, highest = min(quotes, key=lambda q: q[0]), max(quotes, key=lambda q: q[0])
+    text += f"\n\nBest BUY: {lowest[0]} ({lowest[1]})"
+    text += f"\nBest SELL: {highest[0]} ({highest[1]})"
+    return text
+
+def selectApi(user, name):
+    available = ', '.join(api.names())
+    if not name:
+        current = f"Your account is using {accounts()[user].api}.\n\n" if existsAccount(user) else ''
+        return f"{current}Available exchanges: {available}\n\ne.g. /selectApi {api.DEFAULT}"
+    exchange = api.get_api(name.strip())
+    if exchange is None:
+        return f"Unknown exchange: {name}. Available exchanges: {available}"
+    if not existsAccount(user):
+        return "You do not have an account. /newAccount"
+    accounts()[user].api = exchange.name
+    return f"Your account now trades on {exchange}."
+
+def costMethod(user, method):
+    available = ', '.join(lots.METHODS)
+    if not existsAccount(user):
+        return "You do not have an account. /newAccount"
+    account = accounts()[user]
+    if not method:
+        return f"Your account uses the {account.method} cost method.\n\nAvailable methods: {available}"
+    method = method.strip().upper()
+    if method not in lots.METHODS:
+        return f"Unknown cost method: {method}. Available methods: {available}"
+    account.use_method(method)
+    return f"Your account now uses the {method} cost method."
+
+def account(bot_name, user, superuser, other):
+    target = other if other != '' else user
+    if not api.is_authorized(bot_name, user, superuser, target):
+        return f"You are not allowed to view {target} account."
+    if existsAccount(target):
+        exchange = accounts()[target].exchange()
+        try:
+            text = str(accounts()[target])
+        except ValueError as e: # a position has no price, neither fresh nor stale
+            return f"Cannot value {target} account: {e}"
+        return f"{text}\n\n⚠️ {exchange} is unavailable, prices may be stale." if exchange.circuit.is_open() else text
+    elif target == user:
+        return "You do not have an account. /newAccount"
+    return f"{target} do not have an account."
+
+def history(bot_name, user, superuser, other):
+    target = other if other != '' else user
+    if not api.is_authorized(bot_name, user, superuser, target):
+        return f"You are not allowed to view {target} trades."
+    if existsAccount(target):
+        return accounts()[target].history(last=20)
+    elif target == user:
+        return "You do not have an account. /newAccount"
+    return f"{target} do not have an account."
+
+def __float(s):
+    try:
+        return True, float(s)
+    except ValueError:
+        return False, 0
+
+def existsAccount(user):
+    return user in accounts()
+
+def newAccount(user, args=''):
+    args = args.split()
+    balance = args[0] if args else '1000'
+    success, balance = __float(balance)
+    if not success:
+        return "Balance must be in decimal format. For example: 500.25 USD"
+    currency = 'USD' if len(args) < 2 else args[1]
+    exchange = api.get_api(args[2] if len(args) > 2 else api.DEFAULT)
+    if exchange is None:
+        return f"Unknown exchange: {args[2]}. Available exchanges: {', '.join(api.names())}"
+    account = Account(user, balance, currency, exchange.name)
+    if existsAccount(user): # the new account replaces the positions of the old one
+        accounts().remove(user)
+    accounts()[user] = account
+    return f"Your account has been created successfully.\n\n{account}"
+
+def deleteAccount(user):
+    if not existsAccount(user):
+        return "You do not have an account to delete."
+    accounts().remove(user)
+    file = accounts().file(user)
+    if os.path.exists(file):
+        os.remove(file)
+    return "Your account has been deleted."
+
+def __trade_price(exchange, symbol):
+    """ Current price to fill an order, or an error message (orders are never filled at a stale price) """
+    current = exchange.get_price(symbol, max_age=0)
+    if isinstance(current, api.StalePrice):
+        return f"{exchange} is unavailable, the last {symbol.upper()} price is {round(current.age)}s old. Please, try again later."
+    return current
+
+def __fill_price(exchange, account, symbol, action, amount=None):
+    """
+    Price to fill an order and a description of the fill, or an error message and None.
+    The price is the VWAP of the order book levels the order consumes, or the ticker price without a book.
+    amount: None for the maximum available
+    """
+    book = exchange.get_book(symbol) if DEPTH_FILLS else None
+    if isinstance(book, api.Book):
+        base = symbol_of(symbol, account.currency)
+        if action == 'BUY' and amount is None: # spend the balance less the fee, as Account.buy_all does
+            budget = account.balance - money.fee(account.balance, money.rate(exchange.fee))
+            fill = execution.walk(book.asks, base, account.currency, budget=budget, up=True) if budget > 0 else False
+        else:
+            units = account.get(base) if amount is None else money.units(amount, base)
+            levels = book.asks if action == 'BUY' else book.bids
+            fill = execution.walk(levels, base, account.currency, units, up=action == 'BUY') if units > 0 else False
+        if fill is None:
+            return f"Not enough liquidity in the {exchange} {symbol.upper()} order book for this order.", None
+        if fill: # nothing to fill otherwise, the account explains why
+            return fill.current(), str(fill)
+    current = __trade_price(exchange, symbol)
+    return current, ''
+
+def trade(user, order):
+    if not existsAccount(user):
+        return "You do not have an account. /newAccount"
+    account = accounts()[user]
+    exchange = account.exchange()
+    args = order.split(' ', 3)
+    action = args[0].upper()
+    if len(args) < 3 or action not in ORDERS:
+        return "Invalid order syntax: /trade [BUY, SELL] amount symbol [comment]"
+    success, amount = __float(args[1])
+    if not success:
+        return "Amount must be in decimal format. For example: 1.5 ETH"
+    symbol = args[2] + account.currency if account.currency not in args[2] else args[2]
+    comment = ' '.join(args[3:]) if len(args) > 3 else ''
+    if not exchange.listed(symbol):
+        return f"Invalid symbol: {symbol.upper()}. See /list"
+    symbol = exchange.symbol(symbol)
+    current, detail = __fill_price(exchange, account, symbol, action, amount)
+    if isinstance(current, str):
+        return current
+    if action == 'BUY':
+        return account.buy(symbol, current, amount, exchange.fee, comment, detail)
+    elif action == 'SELL':
+        return account.sell(symbol, current, amount, exchange.fee, comment, detail)
+
+def tradeAll(user, order):
+    if not existsAccount(user):
+        return "You do not have an account. /newAccount"
+    account = accounts()[user]
+    exchange = account.exchange()
+    args = order.split(' ', 2)
+    action = args[0].upper()
+    if len(args) < 2 or action not in ORDERS:
+        return "Invalid order syntax: /tradeAll [BUY, SELL] symbol [comment]"
+    symbol = args[1] + account.currency if account.currency not in args[1] else args[1]
+    comment = ' '.join(args[2:]) if len(args) > 2 else ''
+    if not exchange.listed(symbol):
+        return f"Invalid symbol: {symbol.upper()}. See /list"
+    symbol = exchange.symbol(symbol)
+    current, detail = __fill_price(exchange, account, symbol, action)
+    if isinstance(current, str):
+        return current
+    if action == 'BUY':
+        return account.buy_all(symbol, current, exchange.fee, comment, detail)
+    elif action == 'SELL':
+        return account.sell_all(symbol, current, exchange.fee, comment, detail)
+
+def memory():
+    return memory_report.report(accounts())
+
+def refresh_pairs():
+    for exchange in api.APIS.values():
+        exchange.refresh_pairs()
+
+def batch(user, text):
+    if not existsAccount(user):
+        return "You do not have an account. /newAccount"
+    account = accounts()[user]
+    exchange = account.exchange()
+    orders = []
+    comments = []
+    for line in re.split(r'[\n;]', text):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            comments.append(line[1:].strip())
+            continue
+        args = line.split()
+        action = args[0].upper()
+        if len(args) != 3 or action not in ORDERS:
+            return f"Invalid order: {line}\n\nSyntax: {BATCH_SYNTAX}"
+        amount = None
+        if args[1].upper() != 'ALL':
+            success, amount = __float(args[1])
+            if not success:
+                return f"Invalid order: {line}\n\nAmount must be in decimal format or ALL. For example: 1.5 ETH"
+        symbol = args[2] + account.currency if account.currency not in args[2] else args[2]
+        if not exchange.listed(symbol):
+            return f"Invalid symbol: {symbol.upper()}. See /list"
+        orders.append((action, exchange.symbol(symbol), amount))
+    if not orders:
+        return f"Syntax: {BATCH_SYNTAX}"
+    if len(orders) > MAX_BATCH_ORDERS:
+        return f"Too many orders: {len(orders)}. Maximum is {MAX_BATCH_ORDERS}."
+    prices = exchange.get_prices(symbol for _, symbol, _ in orders)
+    if not isinstance(prices, dict):
+        return prices
+    trades = len(account.historic)
+    result = account.batch(orders, prices, exchange.fee, ' '.join(comments))
+    if len(account.historic) > trades:
+        account.save(accounts().file(user))
+    return result
+
+def load(lazy=False, owns=None, indexed=False):
+    """
+    Load the accounts (none until they are used if lazy) and add them to the exposure index
+    owns: filter of the users served by this process, all by default
+    indexed: the exposure index was restored from a snapshot, a lazy load reads no account
+    """
+    loaded = accounts()
+    Path(loaded.directory).mkdir(parents=True, exist_ok=True)
+    if lazy and indexed:
+        return
+    for user in os.listdir(loaded.directory):
+        if owns is None or owns(user):
+            account = Account.load(loaded.file(user))
+            loaded.exposure.add(account)
+            if not lazy:
+                loaded[user] = account
+
+def export_csv(user):
+    """ (path of a new CSV file with the trades of user, None), or (None, error message). The caller removes the file """
+    if not existsAccount(user):
+        return None, "You do not have an account. /newAccount"
+    return export.account_csv(accounts()[user]), None
+
+def export_all():
+    """ Export the trades of every account, accounts not in memory are read one at a time and not kept """
+    exported = accounts()
+    users = sorted(set(os.listdir(exported.directory) if os.path.isdir(exported.directory) else ()) | set(dict.keys(exported)))
+    resident = (dict.get(exported, user) or Account.load(exported.file(user)) for user in users)
+    path, count = export.bulk(resident)
+    return f"{count} trades of {len(users)} accounts exported to {path}"
+
+def exposure():
+    return exposure_index.report(accounts().exposure.totals())
+
+def exposure_totals():
+    return accounts().exposure.totals()
+
+def save():
+    saved = accounts()
+    for account in saved.values():
+        account.save(saved.file(account.user))
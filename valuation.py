@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental account valuation.
+
+Each account caches the market value of its positions, keyed by its trade version and exchange. Positions are converted
+to the account currency along the routes of conversion.py, so a position needs no pair in that currency. HOLDERS indexes
+valued accounts by the pairs of their routes, so a quote tick only revalues the positions converted through that pair.
+"""
+
+import api
+import money
+import conversion
+import threading
+
+from weakref import WeakSet
+
+LOCK = threading.RLock()
+
+HOLDERS = dict() # (exchange name, pair symbol) to WeakSet of Account
+
+def __pairs(values):
+    return set(pair for route, _ in values.values() for pair, _ in route)
+
+def __index(account, exchange, routes):
+    """ Value every position of the account with the cached quotes and register it as holder """
+    if account._valued:
+        for pair in __pairs(account._values):
+            HOLDERS.get((account._valued[1], pair), set()).discard(account)
+    values = dict()
+    for symbol, amount in account.positions.items():
+        route = routes[symbol]
+        values[symbol] = (route, money.cost(amount, symbol, conversion.rate(exchange, route), account.currency))
+    for pair in __pairs(values):
+        HOLDERS.setdefault((exchange.name, pair), WeakSet()).add(account)
+    account._values = values
+    account._equity = account.balance + sum(value for _, value in values.values())
+    account._valued = (account._version, exchange.name)
+
+def __value(account, exchange, routes):
+    with LOCK:
+        if account._valued != (account._version, exchange.name):
+            __index(account, exchange, routes)
+        return account._equity
+
+def equity(account):
+    """ Equity of the account in units of its currency, recomputed only for trades and ticks of pairs it converts through """
+    exchange = account.exchange()
+    routes = conversion.routes(exchange, account.positions, account.currency)
+    conversion.refresh(exchange, routes.values()) # changed prices are applied by tick
+    return __value(account, exchange, routes)
+
+def total(accounts):
+    """ Equity of every account, by user, refreshing the quotes of each exchange in a single batch """
+    accounts = list(accounts)
+    routes = { account.user: conversion.routes(account.exchange(), account.positions, account.currency) for account in accounts }
+    for exchange in set(account.exchange() for account in accounts):
+        conversion.refresh(exchange, [route for account in accounts if account.exchange() is exchange for route in routes[account.user].values()])
+    return { account.user: __value(account, account.exchange(), routes[account.user]) for account in accounts }
+
+def tick(exchange, pair, price):
+    with LOCK:
+        for account in list(HOLDERS.get((exchange.name, pair), ())):
+            if account._valued != (account._version, exchange.name):
+                continue
+            for symbol, (route, previous) in list(account._values.items()):
+                if any(hop == pair for hop, _ in route):
+                    value = money.cost(account.positions[symbol], symbol, conversion.rate(exchange, route), account.currency)
+                    account._values[symbol] = (route, value)
+                    account._equity += value - previous
+
+api.TICK_LISTENERS.append(tick)
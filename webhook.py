@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Webhook ingestion: a local HTTP server receiving Telegram updates instead of polling getUpdates.
+
+Requests must carry the secret token registered with setWebhook. Updates are handed to the dispatcher queue,
+which is bounded by QUEUE_SIZE: when it is full the server answers 503 so Telegram (or a load balancer) retries later.
+"""
+
+import os
+import sys
+import json
+import hmac
+import logs
+import secrets
+import logging
+import metrics
+import threading
+
+from telegram import Update
+from requests import post
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOST = '127.0.0.1'
+PORT = 8443
+PATH = '/telegram'
+
+QUEUE_SIZE = 256
+RETRY_AFTER_SECONDS = 1
+MAX_BODY_BYTES = 1 << 20
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+SECRET_FILE = 'tokens/webhook'
+
+def shared_secret():
+    """ Secret shared by every instance behind a load balancer, None if there is none """
+    try:
+        with open(SECRET_FILE, 'r') as webhook_token:
+            return webhook_token.read().strip()
+    except FileNotFoundError:
+        return None
+
+def read_secret():
+    """ Shared secret, or a random one for this process """
+    return shared_secret() or secrets.token_urlsafe(32)
+
+class Handler(BaseHTTPRequestHandler):
+
+    routes = dict() # path to (bot, dispatcher queue)
+    secret = None
+    lock = threading.Lock() # makes the queue size check and the put atomic
+
+    def respond(self, status, result, **headers):
+        metrics.inc('webhook_updates_total', result=result)
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        route = self.routes.get(self.path.split('?', 1)[0])
+        if route is None:
+            return self.respond(404, 'not_found')
+        bot, queue = route
+        if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), self.secret):
+            return self.respond(403, 'forbidden')
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_BODY_BYTES:
+            return self.respond(400, 'invalid')
+        body = self.rfile.read(length)
+        try:
+            update = Update.de_json(json.loads(body), bot)
+        except (ValueError, TypeError):
+            return self.respond(400, 'invalid')
+        with self.lock: # the dispatcher queue is unbounded, concurrent requests must not all pass the check
+            queued = queue.qsize()
+            if queued < QUEUE_SIZE:
+                queue.put(update)
+        if queued >= QUEUE_SIZE:
+            logs.event('webhook_backpressure', level=logging.WARNING, queued=queued)
+            return self.respond(503, 'backpressure', **{ 'Retry-After': str(RETRY_AFTER_SECONDS) })
+        self.respond(200, 'accepted')
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(bot, queue, secret, host=HOST, port=PORT, path=PATH):
+    """ Serve the webhook in a background thread, feeding updates to queue """
+    handler = type('WebhookHandler', (Handler,), { 'routes': { path: (bot, queue) }, 'secret': secret })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    return server
+
+def route(server, bot, queue, path):
+    """ Serve the updates of another bot on path of a running webhook server """
+    server.RequestHandlerClass.routes[path] = (bot, queue)
+
+if __name__ == '__main__':
+    # Post recorded updates to a local webhook: python3 webhook.py updates.json [url]
+    # The file holds one update object or a list of them, the secret is read from WEBHOOK_SECRET or tokens/webhook
+    secret = os.environ.get('WEBHOOK_SECRET') or shared_secret()
+    if not secret: # a random one would never match the secret of the server
+        sys.exit(f"No webhook secret: set WEBHOOK_SECRET or write the secret of the server to {SECRET_FILE}")
+    with open(sys.argv[1], 'r') as updates_file:
+        updates = json.load(updates_file)
+    url = sys.argv[2] if len(sys.argv) > 2 else f"http://{HOST}:{PORT}{PATH}"
+    for update in updates if isinstance(updates, list) else [updates]:
+        print(update.get('update_id'), post(url, json=update, headers={ SECRET_HEADER: secret }).status_code)